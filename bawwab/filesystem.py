@@ -39,7 +39,7 @@ logger = get_logger ()
 bp = Blueprint('filesystem')
 
 @contextmanager
-def translateSSHError ():
+def translateSSHError (user):
 	try:
 		yield
 	except asyncssh.sftp.SFTPNoSuchFile:
@@ -48,6 +48,10 @@ def translateSSHError ():
 		raise Forbidden ('permissiondenied')
 	except asyncssh.sftp.SFTPFailure:
 		raise ServerError ('error')
+	except (asyncssh.misc.Error, asyncssh.sftp.SFTPConnectionLost, BrokenPipeError):
+		# The channel might be dead.
+		user.sftpFailed ()
+		raise
 
 @bp.route ('/<path:path>', methods=['GET', 'DELETE', 'PUT', 'POST'], stream=True)
 @authenticated
@@ -67,7 +71,7 @@ async def fileGetDelete (request, user, path):
 		raise Forbidden ('terms_of_service')
 
 	if request.method == 'GET':
-		with translateSSHError ():
+		with translateSSHError (user):
 			s = await client.stat (path)
 			if stat.S_ISDIR (s.permissions):
 				# return directory listing instead
@@ -116,7 +120,7 @@ async def fileGetDelete (request, user, path):
 		# stream=True for the request body.
 		kind = request.args.get ('kind', None)
 		if kind == 'PROPFIND':
-			with translateSSHError ():
+			with translateSSHError (user):
 				follow = int (request.args.get ('follow', 1)) != 0
 				if follow:
 					s = await client.stat (path)
@@ -127,22 +131,22 @@ async def fileGetDelete (request, user, path):
 					s['target'] = await client.readlink (path)
 				return json (dict (status='ok', result=ret))
 		elif kind == 'MKCOL':
-			with translateSSHError ():
+			with translateSSHError (user):
 				await client.makedirs (path, exist_ok=True)
 			return json ({'status': 'ok'})
 		elif kind == 'MOVE':
 			print ('source', path, request.args.get ('to'))
-			with translateSSHError ():
+			with translateSSHError (user):
 				await client.rename (path, request.args.get ('to'))
 			return json ({'status': 'ok'})
 		elif kind == 'COPY':
-			with translateSSHError ():
+			with translateSSHError (user):
 				await client.copy ([path], request.args.get ('to'), recurse=True)
 			return json ({'status': 'ok'})
 		else:
 			return json ({'status': 'invalid_method'}, status=405)
 	elif request.method == 'PUT':
-		with translateSSHError ():
+		with translateSSHError (user):
 			fd = await client.open (path, 'wb')
 			try:
 				while True:
@@ -154,7 +158,7 @@ async def fileGetDelete (request, user, path):
 				await fd.close ()
 			return json ({'status': 'ok'})
 	elif request.method == 'DELETE':
-		with translateSSHError ():
+		with translateSSHError (user):
 			s = await client.stat (path)
 			if stat.S_ISDIR (s.permissions):
 				await client.rmtree (path)
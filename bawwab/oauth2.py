@@ -27,9 +27,13 @@ authorization, fetching a token and returning user info.
 See https://tools.ietf.org/html/rfc6749
 """
 
-import urllib.parse
+import urllib.parse, asyncio
 import aiohttp
+import jwt
 from furl import furl
+from structlog import get_logger
+
+logger = get_logger ()
 
 class Oauth2Error (Exception):
 	pass
@@ -37,12 +41,75 @@ class Oauth2Error (Exception):
 class Oauth2InvalidGrant (Oauth2Error):
 	pass
 
+class JwksCache:
+	"""
+	Cache for a JSON Web Key Set, indexed by key id.
+
+	The set is fetched again when it is older than maxAge or an unknown key
+	id shows up, i.e. the server rotated its keys. The latter happens at most
+	every minRefresh seconds, so bogus tokens cannot make us hammer the
+	server.
+	"""
+
+	__slots__ = ('http', 'maxAge', 'minRefresh', '_keys', '_fetched', '_lock')
+
+	def __init__ (self, http, maxAge=24*60*60, minRefresh=60):
+		self.http = http
+		self.maxAge = maxAge
+		self.minRefresh = minRefresh
+		self._keys = dict ()
+		self._fetched = None
+		self._lock = asyncio.Lock ()
+
+	async def _refresh (self, url):
+		async with self.http.get (url) as resp:
+			if resp.status != 200:
+				raise Oauth2Error ('jwks')
+			keyset = await resp.json ()
+		self._keys = dict ((k['kid'], k) for k in keyset.get ('keys', []) if 'kid' in k)
+		self._fetched = asyncio.get_running_loop ().time ()
+
+	async def get (self, url, kid):
+		""" Get JWK dict for key id kid from set at url or None """
+		loop = asyncio.get_running_loop ()
+		key = self._keys.get (kid)
+		if key is not None and loop.time () - self._fetched < self.maxAge:
+			return key
+
+		async with self._lock:
+			key = self._keys.get (kid)
+			age = loop.time () - self._fetched if self._fetched is not None else None
+			if age is None or age >= self.maxAge or \
+					(key is None and age >= self.minRefresh):
+				await self._refresh (url)
+				key = self._keys.get (kid)
+			return key
+
 class Oauth2Client:
-	__slots__ = ('id', 'secret')
+	__slots__ = ('id', 'secret', 'http', 'verifyIdToken', 'jwks')
+
+	# Asymmetric algorithms only, we never share a secret with the server.
+	idTokenAlgorithms = frozenset (['RS256', 'RS384', 'RS512', 'PS256',
+			'PS384', 'PS512', 'ES256', 'ES384', 'ES512'])
+	# Token claims, which are not part of the user info
+	idTokenOnlyClaims = frozenset (['iss', 'aud', 'exp', 'iat', 'nbf',
+			'auth_time', 'jti', 'azp', 'nonce', 'typ', 'acr', 'at_hash',
+			'c_hash', 'sid', 'session_state'])
+
+	def __init__ (self, id, secret, http, verifyIdToken=False):
+		"""
+		http is a long-lived aiohttp.ClientSession, which is shared by all
+		requests, so connections can be reused. It is owned by the caller.
 
-	def __init__ (self, id, secret):
+		With verifyIdToken the user info is taken from the token endpoint’s
+		ID token, which is verified locally, instead of asking the userinfo
+		endpoint.
+		"""
 		self.id = id
 		self.secret = secret
+		self.http = http
+		self.verifyIdToken = verifyIdToken
+		self.jwks = JwksCache (http)
 
 	async def authorize (self, state, scope=None, redirectUri=None, code=None):
 		"""
@@ -64,70 +131,150 @@ class Oauth2Client:
 			for k in list (query.keys ()):
 				if query[k] is None:
 					query.pop (k)
-			return self.authUrl.add (query_params=query)
+			return (await self.getUrl ('auth')).add (query_params=query)
 		else:
-			async with aiohttp.ClientSession() as session:
-				query = dict (grant_type='authorization_code', code=code,
-						redirect_uri=redirectUri, client_id=self.id,
-						client_secret=self.secret)
-				async with session.post (str (self.tokenUrl), data=query) as resp:
-					token = await resp.json ()
-					if resp.status == 400:
-						raise {'invalid_grant': Oauth2InvalidGrant}.get (token['error'], Exception) (token['error'])
-					elif resp.status == 200:
-						# ok
-						pass
-					else:
-						raise Exception ('unexpected status code')
-
-				headers = {'Authorization': f'{token["token_type"]} {token["access_token"]}'}
-				async with session.get (str (self.userinfoUrl), headers=headers) as resp:
-					userinfo = await resp.json ()
-					if resp.status == 200:
-						# ok
-						pass
-					else:
-						raise Exception ('unexpected status code')
+			session = self.http
+			query = dict (grant_type='authorization_code', code=code,
+					redirect_uri=redirectUri, client_id=self.id,
+					client_secret=self.secret)
+			async with session.post (str (await self.getUrl ('token')), data=query) as resp:
+				token = await resp.json ()
+				if resp.status == 400:
+					raise {'invalid_grant': Oauth2InvalidGrant}.get (token['error'], Exception) (token['error'])
+				elif resp.status == 200:
+					# ok
+					pass
+				else:
+					raise Exception ('unexpected status code')
+
+			if self.verifyIdToken and 'id_token' in token:
+				# saves a round-trip
+				return token, await self.decodeIdToken (token['id_token'])
+
+			headers = {'Authorization': f'{token["token_type"]} {token["access_token"]}'}
+			async with session.get (str (await self.getUrl ('userinfo')), headers=headers) as resp:
+				userinfo = await resp.json ()
+				if resp.status == 200:
+					# ok
+					pass
+				else:
+					raise Exception ('unexpected status code')
 			return token, userinfo
 
-	@property
-	def authUrl (self):
-		raise NotImplementedError ()
+	async def decodeIdToken (self, idToken):
+		""" Verify ID token and return its user info claims """
+		try:
+			header = jwt.get_unverified_header (idToken)
+		except jwt.InvalidTokenError:
+			raise Oauth2Error ('invalid_id_token')
+		alg = header.get ('alg')
+		if alg not in self.idTokenAlgorithms:
+			raise Oauth2Error ('invalid_id_token')
+
+		try:
+			key = await self.jwks.get (str (await self.getUrl ('certs')), header.get ('kid'))
+		except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+			raise Oauth2Error ('jwks')
+		if key is None:
+			raise Oauth2Error ('unknown_key')
+
+		try:
+			claims = jwt.decode (idToken,
+					key=jwt.PyJWK (key, algorithm=alg).key,
+					algorithms=[alg],
+					audience=self.id,
+					issuer=await self.getIssuer (),
+					options=dict (require=['exp', 'iat', 'sub']),
+					# allow for some clock skew
+					leeway=30)
+		except jwt.PyJWTError:
+			raise Oauth2Error ('invalid_id_token')
+		return dict ((k, v) for k, v in claims.items () if k not in self.idTokenOnlyClaims)
 
-	@property
-	def tokenUrl (self):
+	async def getUrl (self, name):
+		"""
+		Get endpoint URL name (auth, token, userinfo, logout or certs) as a new
+		furl object, which the caller may modify.
+		"""
 		raise NotImplementedError ()
 
-	@property
-	def userinfoUrl (self):
+	async def getIssuer (self):
+		""" Get issuer identifier, as used in tokens """
 		raise NotImplementedError ()
 
-# XXX: discover URIs via
-# `curl -X GET https://sso.leibniz-psychology.org/auth/realms/ZPID/.well-known/uma2-configuration`
 class KeycloakClient (Oauth2Client):
-	__slots__ = ('baseUrl', 'realm')
+	__slots__ = ('baseUrl', 'realm', 'discoveryTtl', 'discoveryRetry', '_endpoints',
+			'_expires', '_lock')
+
+	# Map our names to OpenID Connect discovery metadata keys
+	discoveryKeys = dict (
+			auth='authorization_endpoint',
+			token='token_endpoint',
+			userinfo='userinfo_endpoint',
+			logout='end_session_endpoint',
+			certs='jwks_uri',
+			issuer='issuer',
+			)
 
-	def __init__ (self, id, secret, baseUrl, realm):
-		super ().__init__ (id, secret)
+	def __init__ (self, id, secret, baseUrl, realm, http, discoveryTtl=60*60,
+			verifyIdToken=False, discoveryRetry=60):
+		super ().__init__ (id, secret, http, verifyIdToken)
 		self.baseUrl = furl (baseUrl)
 		self.realm = realm
+		self.discoveryTtl = discoveryTtl
+		# wait this long after a failed discovery before trying again
+		self.discoveryRetry = discoveryRetry
+		self._endpoints = None
+		self._expires = None
+		self._lock = asyncio.Lock ()
 
 	def _buildUrl (self):
 		return self.baseUrl / f'realms/{self.realm}/protocol/openid-connect'
 
-	@property
-	def authUrl (self):
-		return self._buildUrl () / 'auth'
+	def _staticEndpoints (self):
+		""" Well-known locations, in case discovery fails """
+		base = self._buildUrl ()
+		endpoints = dict ((k, str (base / k)) for k in self.discoveryKeys.keys ())
+		endpoints['issuer'] = str (self.baseUrl / f'realms/{self.realm}')
+		return endpoints
+
+	async def _discover (self):
+		url = self.baseUrl / f'realms/{self.realm}/.well-known/openid-configuration'
+		async with self.http.get (str (url)) as resp:
+			if resp.status != 200:
+				raise Oauth2Error ('discovery')
+			config = await resp.json ()
+		endpoints = self._staticEndpoints ()
+		for k, v in self.discoveryKeys.items ():
+			if v in config:
+				endpoints[k] = config[v]
+		return endpoints
+
+	async def getEndpoints (self):
+		""" Get all endpoint URLs as strings, cached for discoveryTtl seconds """
+		loop = asyncio.get_running_loop ()
+		if self._endpoints is not None and loop.time () < self._expires:
+			return self._endpoints
 
-	@property
-	def tokenUrl (self):
-		return self._buildUrl () / 'token'
+		async with self._lock:
+			# someone else might have refreshed them while we were waiting
+			if self._endpoints is not None and loop.time () < self._expires:
+				return self._endpoints
+			try:
+				self._endpoints = await self._discover ()
+				self._expires = loop.time () + self.discoveryTtl
+			except (Oauth2Error, aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+				logger.error (__name__ + '.discovery.failed', error=str (e))
+				if self._endpoints is None:
+					self._endpoints = self._staticEndpoints ()
+				# Keep using the old or static ones for a while, so not every
+				# request waits for a failing endpoint.
+				self._expires = loop.time () + self.discoveryRetry
+			return self._endpoints
 
-	@property
-	def userinfoUrl (self):
-		return self._buildUrl () / 'userinfo'
+	async def getUrl (self, name):
+		return furl ((await self.getEndpoints ())[name])
 
-	@property
-	def logoutUrl (self):
-		return self._buildUrl () / 'logout'
+	async def getIssuer (self):
+		return (await self.getEndpoints ())['issuer']
 
@@ -22,14 +22,15 @@
 Interact with processes running on the compute backend
 """
 
-import json, asyncio, sys
-from collections import defaultdict
+import json, asyncio, sys, os, uuid, time
+from bisect import bisect_right
+from collections import defaultdict, deque, OrderedDict
 from functools import partial
 from itertools import chain
 
 from sanic import Blueprint
 from sanic.response import json as jsonResponse
-from sanic.exceptions import Forbidden, InvalidUsage, ServerError, NotFound, InvalidUsage, WebsocketClosed
+from sanic.exceptions import Forbidden, InvalidUsage, ServerError, NotFound, InvalidUsage, WebsocketClosed, SanicException
 
 from websockets.exceptions import WebSocketException
 
@@ -37,7 +38,7 @@ import asyncssh
 
 from structlog import get_logger
 
-from .user import User, authenticated, TermsNotAccepted
+from .user import authenticated, getUser, TermsNotAccepted
 from .action import getAction
 from .util import periodic
 
@@ -49,23 +50,405 @@ bp = Blueprint('process')
 perUserSockets = defaultdict (list)
 # all sockets for a single user, so we can restore his session
 perUserProcesses = defaultdict (dict)
+# set when a socket is added, wakes up waitWritable
+perUserSocketAdded = defaultdict (asyncio.Event)
+# tokens of processes queued or starting, not in perUserProcesses yet. Maps
+# to the task waiting for admission, None while starting.
+perUserStarting = defaultdict (dict)
+# spooled output of processes, outlives the process itself
+perUserSpools = defaultdict (dict)
+
+class ReplayBuffer:
+	"""
+	JSON-encoded messages of a single process, replayed to new sockets.
+
+	The first message (processStart) and everything after the output are
+	always kept, but only the newest maxBytes of output. Dropped output is
+	replaced by a single processTruncated message.
+	"""
+
+	__slots__ = ('token', 'maxBytes', 'head', 'output', 'tail', 'size', 'dropped')
+
+	def __init__ (self, token, maxBytes):
+		self.token = token
+		self.maxBytes = maxBytes
+		# (seq, data)
+		self.head = None
+		self.output = deque ()
+		self.tail = []
+		self.size = 0
+		self.dropped = 0
+
+	def append (self, msg, data):
+		"""
+		Add msg, encoded as data. json.dumps escapes all non-ASCII
+		characters, so its length is the size in bytes.
+		"""
+		item = (msg['seq'], data)
+		if self.head is None:
+			self.head = item
+		elif msg['notify'] == 'processData':
+			self.output.append (item)
+			self.size += len (data)
+			# always keep the newest message
+			while self.size > self.maxBytes and len (self.output) > 1:
+				_, dropped = self.output.popleft ()
+				self.size -= len (dropped)
+				self.dropped += len (dropped)
+		else:
+			self.tail.append (item)
+
+	def since (self, cursor):
+		"""
+		Messages after sequence number cursor. If some of them were dropped
+		already, a processGap message is sent instead.
+		"""
+		if self.head is not None and self.head[0] > cursor:
+			yield self.head[1]
+		if self.dropped and self.output:
+			first = self.output[0][0]
+			if cursor < first - 1:
+				yield json.dumps (dict (notify='processGap', start=max (cursor+1, 1),
+						end=first, token=self.token))
+		for seq, data in chain (self.output, self.tail):
+			if seq > cursor:
+				yield data
+
+	def __iter__ (self):
+		if self.head is not None:
+			yield self.head[1]
+		if self.dropped:
+			yield json.dumps (dict (notify='processTruncated', bytes=self.dropped, token=self.token))
+		for _, data in chain (self.output, self.tail):
+			yield data
+
+	def __len__ (self):
+		return (self.head is not None) + (self.dropped > 0) + len (self.output) + len (self.tail)
+
+class SocketWriter:
+	"""
+	Sends messages to a single websocket from its own task, so a slow
+	client cannot hold up the process or other sockets.
+
+	If more than maxBytes are queued, the socket is closed instead. The
+	client reconnects and gets the process state replayed. Above highWater
+	the socket is not writable and processes stop reading output (see
+	waitWritable).
+	"""
+
+	__slots__ = ('ws', 'maxBytes', 'highWater', 'queue', 'queued', 'ready',
+			'writable', 'closing', 'task')
+
+	def __init__ (self, ws, maxBytes, highWater):
+		self.ws = ws
+		self.maxBytes = maxBytes
+		self.highWater = highWater
+		self.queue = deque ()
+		self.queued = 0
+		self.ready = asyncio.Event ()
+		self.writable = asyncio.Event ()
+		self.writable.set ()
+		self.closing = False
+		self.task = None
+
+	def push (self, data):
+		if self.closing:
+			return
+		if self.queued + len (data) > self.maxBytes:
+			logger.info (__name__ + '.socket.overflow', queued=self.queued)
+			self.queue.clear ()
+			self.queued = 0
+			self.closing = True
+			self.writable.set ()
+		else:
+			self.queue.append (data)
+			self.queued += len (data)
+			if self.queued >= self.highWater:
+				self.writable.clear ()
+		self.ready.set ()
+
+	async def run (self, initial=()):
+		""" Send initial messages, then the queue, until cancelled """
+		try:
+			for data in initial:
+				await self.ws.send (data)
+			while True:
+				await self.ready.wait ()
+				self.ready.clear ()
+				while self.queue:
+					data = self.queue.popleft ()
+					self.queued -= len (data)
+					if self.queued < self.highWater:
+						self.writable.set ()
+					await self.ws.send (data)
+				if self.closing:
+					# try again later
+					await self.ws.close (code=1013, reason='overflow')
+					break
+		except (WebSocketException, WebsocketClosed):
+			# Nothing we can do about.
+			pass
+		finally:
+			# never block processes on a dead socket
+			self.closing = True
+			self.queue.clear ()
+			self.queued = 0
+			self.writable.set ()
+
+class Spool:
+	"""
+	Output of a single process in a file, so it can be paged through
+	without keeping it in memory. index has the (offset, kind) where kind
+	changes. Output beyond maxBytes is not stored.
+	"""
+
+	__slots__ = ('path', 'fd', 'maxBytes', 'size', 'index', 'truncated', 'expires')
+
+	def __init__ (self, directory, maxBytes):
+		# tokens are client-defined, do not use them for paths
+		self.path = os.path.join (directory, f'{uuid.uuid4 ().hex}.spool')
+		# only readable by us, contains the user’s output
+		self.fd = os.fdopen (os.open (self.path,
+				os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600), 'w+b')
+		self.maxBytes = maxBytes
+		self.size = 0
+		self.index = []
+		self.truncated = False
+		# set once the process is gone
+		self.expires = None
+
+	def append (self, kind, data):
+		data = data.encode ('utf-8')
+		if self.truncated or self.size + len (data) > self.maxBytes:
+			self.truncated = True
+			return
+		try:
+			self.fd.write (data)
+		except OSError as e:
+			# never interrupt live output, just stop spooling
+			logger.error (__name__ + '.spool.failed', path=self.path, reason=str (e))
+			self.truncated = True
+			return
+		if not self.index or self.index[-1][1] != kind:
+			self.index.append ((self.size, kind))
+		self.size += len (data)
+
+	async def read (self, offset, length):
+		""" Read chunks within [offset, offset+length) """
+		offset = max (0, min (offset, self.size))
+		end = min (offset+length, self.size)
+		try:
+			self.fd.flush ()
+		except OSError as e:
+			logger.error (__name__ + '.spool.failed', path=self.path, reason=str (e))
+			self.truncated = True
+		# pread does not move the write position
+		loop = asyncio.get_running_loop ()
+		data = await loop.run_in_executor (None, os.pread, self.fd.fileno (),
+				end-offset, offset)
+
+		chunks = []
+		i = max (bisect_right (self.index, (offset, '\uffff')) - 1, 0)
+		while i < len (self.index) and self.index[i][0] < end:
+			start, kind = self.index[i]
+			stop = self.index[i+1][0] if i+1 < len (self.index) else self.size
+			start = max (start, offset)
+			stop = min (stop, end)
+			# range boundaries may split characters
+			chunks.append (dict (offset=start, kind=kind,
+					data=data[start-offset:stop-offset].decode ('utf-8', errors='replace')))
+			i += 1
+		return chunks
+
+	def close (self):
+		self.fd.close ()
+		try:
+			os.unlink (self.path)
+		except FileNotFoundError:
+			pass
+
+	def toDict (self):
+		return dict (size=self.size, truncated=self.truncated)
+
+class OutputBatcher:
+	"""
+	Merges output chunks arriving within window seconds, or up to maxBytes,
+	into as few processData messages as possible. Only consecutive chunks
+	of the same kind are merged, so stream order is kept.
+	"""
+
+	__slots__ = ('send', 'window', 'maxBytes', 'pending', 'size', 'timer')
+
+	def __init__ (self, send, window, maxBytes):
+		self.send = send
+		self.window = window
+		self.maxBytes = maxBytes
+		# [kind, [data]]
+		self.pending = []
+		self.size = 0
+		self.timer = None
+
+	async def push (self, kind, data):
+		if self.pending and self.pending[-1][0] == kind:
+			self.pending[-1][1].append (data)
+		else:
+			self.pending.append ([kind, [data]])
+		self.size += len (data)
+
+		if self.size >= self.maxBytes or self.window <= 0:
+			await self.flush ()
+		elif self.timer is None:
+			loop = asyncio.get_running_loop ()
+			self.timer = loop.call_later (self.window,
+					lambda: asyncio.ensure_future (self.flush ()))
+
+	async def flush (self):
+		if self.timer is not None:
+			self.timer.cancel ()
+			self.timer = None
+		pending = self.pending
+		self.pending = []
+		self.size = 0
+		for kind, chunks in pending:
+			msg = dict (
+					notify='processData',
+					kind=kind,
+					data=''.join (chunks),
+					)
+			await self.send (msg)
+
+class ProcessScheduler:
+	"""
+	Limits the number of running processes per user and in total. Others
+	wait in a FIFO per user; users take turns when slots free up, so a
+	single user cannot starve everyone else.
+	"""
+
+	def __init__ (self, perUser=32, total=1024):
+		self.perUser = perUser
+		self.total = total
+		self.running = defaultdict (int)
+		self.runningTotal = 0
+		# user -> deque of futures
+		self.waiting = OrderedDict ()
+		# statistics
+		self.admitted = 0
+		self.queued = 0
+		self.waitTime = 0
+		self.maxWaitTime = 0
+
+	def _admissible (self, user):
+		return self.running.get (user, 0) < self.perUser and self.runningTotal < self.total
+
+	def _take (self, user):
+		self.running[user] += 1
+		self.runningTotal += 1
+		self.admitted += 1
+
+	def tryAcquire (self, user):
+		""" Take a slot for user if one is free right now """
+		# Users with waiting processes cannot skip their own queue.
+		if user not in self.waiting and self._admissible (user):
+			self._take (user)
+			return True
+		return False
+
+	async def acquire (self, user, notify):
+		"""
+		Wait for a slot for user. await notify (position, queued) is
+		called if the process has to wait.
+		"""
+		if self.tryAcquire (user):
+			return
+
+		loop = asyncio.get_running_loop ()
+		fut = loop.create_future ()
+		q = self.waiting.setdefault (user, deque ())
+		q.append (fut)
+		queued = loop.time ()
+		self.queued += 1
+		try:
+			await notify (len (q), self.waitingTotal)
+			await fut
+		except asyncio.CancelledError:
+			if fut.done () and not fut.cancelled ():
+				# got a slot, but nobody will use it
+				self.release (user)
+			elif fut in q:
+				# _wake may have dropped it already
+				q.remove (fut)
+				if not q and self.waiting.get (user) is q:
+					self.waiting.pop (user)
+			raise
+		finally:
+			waited = loop.time () - queued
+			self.waitTime += waited
+			self.maxWaitTime = max (self.maxWaitTime, waited)
+
+	def release (self, user):
+		self.running[user] -= 1
+		if self.running[user] <= 0:
+			self.running.pop (user)
+		self.runningTotal -= 1
+		self._wake ()
+
+	def _wake (self):
+		""" Admit waiting processes, one user at a time """
+		while self.runningTotal < self.total:
+			for user, q in self.waiting.items ():
+				if self.running.get (user, 0) < self.perUser:
+					break
+			else:
+				break
+
+			fut = q.popleft ()
+			if q:
+				self.waiting.move_to_end (user)
+			else:
+				self.waiting.pop (user)
+			if fut.done ():
+				# cancelled, but its waiter did not run yet
+				continue
+			self._take (user)
+			fut.set_result (None)
+
+	@property
+	def waitingTotal (self):
+		return sum (map (len, self.waiting.values ()))
+
+	def toDict (self):
+		return dict (
+				running=self.runningTotal,
+				waiting=self.waitingTotal,
+				waitingUsers=len (self.waiting),
+				admitted=self.admitted,
+				queued=self.queued,
+				waitTime=self.waitTime,
+				maxWaitTime=self.maxWaitTime,
+				)
 
 class WebsocketProcess:
-	__slots__ = ('token', 'user', 'broadcast', 'command',
+	__slots__ = ('token', 'user', 'broadcast', 'writable', 'command',
 			'messages', 'task', 'stdoutTask', 'stderrTask',
-			'process', 'extraData', 'logger')
+			'process', 'extraData', 'logger', 'output', 'seq', 'spool')
 
-	def __init__ (self, token, user, broadcastFunc, command, extraData):
+	def __init__ (self, token, user, broadcastFunc, writableFunc, command,
+			extraData, spool=None):
 		self.token = token
 		self.user = user
 		self.broadcast = broadcastFunc
+		self.writable = writableFunc
 		self.command = command
 		self.extraData = extraData
 		self.logger = logger.bind (user=dict (name=self.user.name, authId=self.user.authId),
 				command=self.command, extraData=self.extraData, token=self.token)
 
 		# message buffer, for session restore replay
-		self.messages = []
+		self.messages = ReplayBuffer (token, replayBufferBytes)
+		self.output = OutputBatcher (self.send, outputWindow, outputBatchBytes)
+		# sequence number of the next message
+		self.seq = 0
+		self.spool = spool
 		self.task = None
 		self.stdoutTask = None
 		self.stderrTask = None
@@ -79,27 +462,34 @@ class WebsocketProcess:
 
 		assert 'token' not in msg
 		msg['token'] = self.token
-		self.messages.append (msg)
-		await self.broadcast (msg)
-
-	async def run (self, useNewConnection=False):
+		msg['seq'] = self.seq
+		self.seq += 1
+		if self.spool is not None and msg['notify'] == 'processData':
+			self.spool.append (msg['kind'], msg['data'])
+		# encode once for all sockets
+		data = json.dumps (msg)
+		self.messages.append (msg, data)
+		await self.broadcast (data)
+
+	async def run (self):
 		async def sendOutput (kind, fd):
 			try:
 				while True:
+					# Do not read while nobody can receive the output. This
+					# closes the SSH window and stops the remote process.
+					await self.writable ()
 					l = await fd.read (10*1024)
 					if not l:
 						break
-					msg = dict (
-							notify=f'processData',
-							kind=kind,
-							data=l,
-							)
-					await self.send (msg)
+					await self.output.push (kind, l)
 			except Exception:
 				pass
 
 		async def f (p):
 			result = await p.wait ()
+			# Output may still be buffered, send it before processExit.
+			await asyncio.gather (self.stdoutTask, self.stderrTask)
+			await self.output.flush ()
 			msg = dict (
 					notify='processExit',
 					status=result.exit_status,
@@ -116,8 +506,7 @@ class WebsocketProcess:
 				extraData=self.extraData,
 				)
 		await self.send (msg)
-		self.process = p = await self.user.createProcess (*self.command,
-				useNewConnection=useNewConnection)
+		self.process = p = await self.user.createProcess (*self.command)
 		print (type (self.process))
 		self.stdoutTask = asyncio.create_task (sendOutput ('stdout', p.stdout))
 		self.stderrTask = asyncio.create_task (sendOutput ('stderr', p.stderr))
@@ -125,31 +514,37 @@ class WebsocketProcess:
 		self.task = asyncio.create_task (f (p))
 
 async def getStatus ():
-	replayBufferMessages = 0
+	replayBufferBytes = 0
+	replayBufferDropped = 0
 	for procs in perUserProcesses.values ():
 		for p in procs.values ():
-			replayBufferMessages += len (p.messages)
+			replayBufferBytes += p.messages.size
+			replayBufferDropped += p.messages.dropped
+
+	spools = list (chain.from_iterable (d.values () for d in perUserSpools.values ()))
 
 	return dict (
 		users=len (perUserSockets),
 		sockets=sum (map (len, perUserSockets.values ())),
+		socketQueueBytes=sum (w.queued for w in chain.from_iterable (perUserSockets.values ())),
 		processes=sum (map (len, perUserProcesses.values ())),
-		replayBufferMessages=replayBufferMessages,
+		replayBufferBytes=replayBufferBytes,
+		replayBufferDropped=replayBufferDropped,
+		spools=len (spools),
+		spoolBytes=sum (s.size for s in spools),
+		scheduler=scheduler.toDict (),
 		)
 
-@bp.route ('/', methods=['POST'])
-@authenticated
-async def processRun (request, authenticatedUser):
+async def startProcess (authenticatedUser, reqData):
+	""" Start or queue the process described by reqData, return its token and status """
 	def substitute (s):
 		return s.format (user=authenticatedUser.name)
 
-	reqData = request.json
 	actionToken = reqData.get ('action', None)
 	command = reqData.get ('command', None)
 	# client-defined extra data, forwarded to start notification
 	extraData = reqData.get ('extraData', None)
 	token = reqData.get ('token', None)
-	useNewConnection = reqData.get ('useNewConnection', False)
 	isAction = bool (actionToken)
 	isCommand = bool (command)
 
@@ -161,7 +556,7 @@ async def processRun (request, authenticatedUser):
 		action = await getAction (actionToken)
 		args = action.arguments
 		authId = args['user']
-		user = await User.get_or_none (authId=authId)
+		user = await getUser (authId)
 		command = list (map (substitute, args['command']))
 	elif isCommand:
 		# use current user instead
@@ -172,29 +567,165 @@ async def processRun (request, authenticatedUser):
 		raise Forbidden ('forbidden')
 	else:
 		processes = perUserProcesses[authenticatedUser]
+		starting = perUserStarting[authenticatedUser]
 
-		if token in processes:
+		if token in processes or token in starting:
 			raise InvalidUsage ('process_exists')
 		elif not token:
 			raise InvalidUsage ('missing_token')
 
-		p = WebsocketProcess (token, user,
-				broadcastFunc=partial (broadcast, authenticatedUser),
-				command=command,
-				extraData=extraData,
-				)
+		# reserve the token while queued and starting
+		starting[token] = None
+		if scheduler.tryAcquire (user):
+			try:
+				await runProcess (authenticatedUser, user, token, command, extraData)
+				return token, 'ok'
+			finally:
+				releaseToken (authenticatedUser, token)
+		else:
+			# Do not hold the request open while waiting, the client is
+			# notified through the socket.
+			starting[token] = asyncio.create_task (queueProcess (authenticatedUser,
+					user, token, command, extraData))
+			return token, 'queued'
+
+def releaseToken (authenticatedUser, token):
+	starting = perUserStarting.get (authenticatedUser, {})
+	starting.pop (token, None)
+	if not starting:
+		perUserStarting.pop (authenticatedUser, None)
+
+async def queueProcess (authenticatedUser, user, token, command, extraData):
+	"""
+	Wait for a free slot and start the process. Failures are reported as
+	processFailed.
+	"""
+	async def notify (msg):
+		msg['token'] = token
+		await broadcast (authenticatedUser, json.dumps (msg))
+
+	async def notifyQueued (position, queued):
+		await notify (dict (notify='processQueued', position=position, queued=queued))
+
+	try:
+		# The process does not exist before it is admitted, so processQueued
+		# is not replayed.
+		await scheduler.acquire (user, notifyQueued)
+		# cannot be cancelled any more
+		perUserStarting[authenticatedUser][token] = None
+		await runProcess (authenticatedUser, user, token, command, extraData)
+	except asyncio.CancelledError:
+		await notify (dict (notify='processFailed', reason='cancelled'))
+		raise
+	except SanicException as e:
+		await notify (dict (notify='processFailed', reason=str (e)))
+	except Exception:
+		_, _, exc_info = sys.exc_info ()
+		logger.error (__name__ + '.queue.failed', token=token, exc_info=exc_info)
+		await notify (dict (notify='processFailed', reason='error'))
+	finally:
+		releaseToken (authenticatedUser, token)
+
+async def runProcess (authenticatedUser, user, token, command, extraData):
+	""" Start the process, which already has a slot in the scheduler """
+	processes = perUserProcesses[authenticatedUser]
+	spools = perUserSpools[authenticatedUser]
+	spool = None
+	if spoolDir:
 		try:
-			await p.run (useNewConnection=useNewConnection)
-			processes[token] = p
-			return jsonResponse ({'status': 'ok', 'token': token})
-		except asyncssh.misc.PermissionDenied:
-			raise Forbidden ('locked_out')
-		except TermsNotAccepted:
-			raise Forbidden ('terms_of_service')
+			spool = Spool (spoolDir, spoolMaxBytes)
+		except OSError as e:
+			logger.error (__name__ + '.spool.failed', reason=str (e))
+	p = WebsocketProcess (token, user,
+			broadcastFunc=partial (broadcast, authenticatedUser),
+			writableFunc=partial (waitWritable, authenticatedUser),
+			command=command,
+			extraData=extraData,
+			spool=spool,
+			)
+	try:
+		await p.run ()
+		p.task.add_done_callback (lambda t: scheduler.release (user))
+		processes[token] = p
+		if spool:
+			# replaces the spool of a dead process with the same token
+			old = spools.get (token)
+			spools[token] = spool
+			if old:
+				old.close ()
+	except asyncssh.misc.PermissionDenied:
+		raise Forbidden ('locked_out')
+	except TermsNotAccepted:
+		raise Forbidden ('terms_of_service')
+	finally:
+		if p.task is None:
+			scheduler.release (user)
+		if spool and spools.get (token) is not spool:
+			spool.close ()
+
+@bp.route ('/', methods=['POST'])
+@authenticated
+async def processRun (request, authenticatedUser):
+	"""
+	Start a process. If the user is at their limit, it is queued and status
+	is queued. processStart or processFailed follows through the socket.
+	"""
+	token, status = await startProcess (authenticatedUser, request.json)
+	return jsonResponse ({'status': status, 'token': token})
+
+@bp.route ('/batch', methods=['POST'])
+@authenticated
+async def processBatch (request, authenticatedUser):
+	"""
+	Start multiple processes, each described like a processRun request.
+	They share the user’s connection and at most batchConcurrency are
+	started at the same time, others may be queued. Duplicate or missing
+	tokens fail only their entry.
+	"""
+	reqData = request.json
+	processes = reqData.get ('processes', None) if isinstance (reqData, dict) else None
+	if not isinstance (processes, list) or not all (isinstance (x, dict) for x in processes):
+		raise InvalidUsage ('invalid_batch')
+	if len (processes) > batchMaxSize:
+		raise InvalidUsage ('batch_too_large')
+
+	semaphore = asyncio.Semaphore (batchConcurrency)
+	async def start (procData):
+		async with semaphore:
+			try:
+				token, status = await startProcess (authenticatedUser, procData)
+				return dict (status=status, token=token)
+			except SanicException as e:
+				reason = str (e)
+			except KeyError:
+				# unknown action
+				reason = 'notfound'
+			except ValueError as e:
+				reason = str (e)
+			except Exception:
+				# Other entries may be running already, their tokens must
+				# be returned.
+				_, _, exc_info = sys.exc_info ()
+				request.ctx.logger.error (__name__ + '.batch.failed',
+						token=procData.get ('token'), exc_info=exc_info)
+				reason = 'error'
+			return dict (status='error', token=procData.get ('token'), reason=reason)
+
+	results = await asyncio.gather (*map (start, processes))
+	return jsonResponse (dict (status='ok', processes=results))
 
 @bp.route ('/<token>', methods=['DELETE'])
 @authenticated
 async def processKill (request, user, token):
+	starting = perUserStarting.get (user, {})
+	if token in starting:
+		task = starting[token]
+		if task is None:
+			# being started right now
+			raise InvalidUsage ('process_starting')
+		task.cancel ()
+		return jsonResponse (dict (status='ok'))
+
 	processes = perUserProcesses[user]
 	p = processes.get (token, None)
 	if p is None:
@@ -202,45 +733,104 @@ async def processKill (request, user, token):
 	p.process.terminate ()
 	return jsonResponse (dict (status='ok'))
 
-async def broadcast (recipient, msg):
-	if len (perUserSockets[recipient]) > 0:
-		done, pending = await asyncio.wait ([socket.send (json.dumps (msg))
-				for socket in perUserSockets[recipient]])
-		assert not pending
-		for d in done:
-			try:
-				d.result ()
-			except WebSocketException:
-				# Nothing we can do about.
-				pass
-			except WebsocketClosed:
-				pass
+@bp.route ('/<token>/output', methods=['GET'])
+@authenticated
+async def processOutput (request, user, token):
+	"""
+	Spooled output of a process. Either length bytes starting at offset,
+	or the last tail bytes.
+	"""
+	spool = perUserSpools.get (user, {}).get (token)
+	if spool is None:
+		raise NotFound ('notfound')
+
+	try:
+		tail = request.args.get ('tail')
+		if tail is not None:
+			length = min (int (tail), spoolMaxRead)
+			offset = max (spool.size - length, 0)
+		else:
+			offset = int (request.args.get ('offset', 0))
+			length = min (int (request.args.get ('length', spoolMaxRead)), spoolMaxRead)
+	except ValueError:
+		raise InvalidUsage ('invalid_range')
+	if offset < 0 or length < 0:
+		raise InvalidUsage ('invalid_range')
+
+	chunks = await spool.read (offset, length)
+	return jsonResponse (dict (status='ok', chunks=chunks, **spool.toDict ()))
+
+async def broadcast (recipient, data):
+	""" Queue encoded message data for all sockets of recipient """
+	for writer in perUserSockets.get (recipient, []):
+		writer.push (data)
+
+async def waitWritable (recipient):
+	"""
+	Wait until at least one socket of recipient is below its high-water
+	mark. Without any sockets output only goes to the replay buffer and
+	there is nothing to wait for.
+	"""
+	while True:
+		writers = perUserSockets.get (recipient)
+		if not writers or any (w.writable.is_set () for w in writers):
+			return
+		# a new socket can take output as well
+		added = perUserSocketAdded[recipient]
+		waiters = [asyncio.create_task (w.writable.wait ()) for w in writers]
+		waiters.append (asyncio.create_task (added.wait ()))
+		try:
+			await asyncio.wait (waiters, return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			for t in waiters:
+				t.cancel ()
 
 @bp.websocket('/notify')
 @authenticated
 async def processNotify (request, user, ws):
+	# requests will follow soon
+	user.prewarm ()
+
+	# Clients can resume with ?cursor=<token>:<seq>,…, the last sequence
+	# number seen for each process. Invalid cursors get a full replay.
+	cursors = {}
+	for c in request.args.get ('cursor', '').split (','):
+		token, sep, seq = c.rpartition (':')
+		if sep and seq.isdigit ():
+			cursors[token] = int (seq)
+
 	# first send the process state
 	processes = perUserProcesses[user]
-	# We must listify the iterator, since this loop can be interrupted by
-	# a process create.
-	for k, p in list (processes.items ()):
+	replay = []
+	for k, p in processes.items ():
 		# do not replay if dead
 		if p.process.is_closing ():
 			continue
 		# must be in order
-		for msg in p.messages:
-			await ws.send (json.dumps (msg))
-
-	# then add the socket to broadcast
-	perUserSockets[user].append (ws)
+		cursor = cursors.get (k)
+		if cursor is None:
+			replay.extend (p.messages)
+		else:
+			replay.extend (p.messages.since (cursor))
+
+	# then add the socket to broadcast. There must be no await in between,
+	# or we miss messages.
+	writer = SocketWriter (ws, socketQueueBytes, socketHighWater)
+	perUserSockets[user].append (writer)
+	added = perUserSocketAdded.pop (user, None)
+	if added:
+		added.set ()
+	writer.task = asyncio.create_task (writer.run (replay))
 
 	try:
 		while True:
 			# we don’t support any requests and discard any data sent
 			data = await ws.recv ()
 	finally:
+		writer.task.cancel ()
+		writer.writable.set ()
 		l = perUserSockets[user]
-		l.remove (ws)
+		l.remove (writer)
 		if len (l) == 0:
 			perUserSockets.pop (user)
 
@@ -274,15 +864,80 @@ async def cleanupJob ():
 	for processes in perUserProcesses.values ():
 		removeDictKeys (processes, [x async for x in removeDeadTasks (processes)])
 
+	# keep spools of dead processes for a while
+	now = time.monotonic ()
+	for user, spools in perUserSpools.items ():
+		processes = perUserProcesses.get (user, {})
+		for k, spool in list (spools.items ()):
+			if k in processes:
+				continue
+			if spool.expires is None:
+				spool.expires = now + spoolKeep
+			elif spool.expires < now:
+				spools.pop (k).close ()
+
 	# gc top-level keys as well
 	removeFalseKeys (perUserProcesses)
 	removeFalseKeys (perUserSockets)
+	removeFalseKeys (perUserSpools)
+	removeDictKeys (perUserSocketAdded, [k for k in perUserSocketAdded.keys ()
+			if k not in perUserProcesses])
 
 cleanupThread = None
+# Output kept per process for replay
+replayBufferBytes = 256*1024
+# Maximum size of a socket’s send queue
+socketQueueBytes = 4*1024*1024
+# Processes stop reading output while all sockets have this much queued
+socketHighWater = 256*1024
+# Output is merged for this many seconds or up to this many bytes
+outputWindow = 0.02
+outputBatchBytes = 64*1024
+scheduler = None
+# Processes started at the same time by a batch request, and its size
+batchConcurrency = 4
+batchMaxSize = 64
+# Spool output to this directory, if set
+spoolDir = None
+spoolMaxBytes = 64*1024*1024
+# Seconds spools are kept after the process exited
+spoolKeep = 600
+# Maximum bytes returned by a single read
+spoolMaxRead = 1024*1024
 
 @bp.listener('before_server_start')
 async def setup (app, loop):
-	global cleanupThread
+	global cleanupThread, replayBufferBytes, socketQueueBytes, outputWindow, \
+			outputBatchBytes, socketHighWater, spoolDir, spoolMaxBytes, spoolKeep, \
+			scheduler, batchConcurrency, batchMaxSize
+
+	replayBufferBytes = getattr (app.config, 'PROCESS_REPLAY_BYTES', replayBufferBytes)
+	socketQueueBytes = getattr (app.config, 'PROCESS_SOCKET_QUEUE_BYTES', socketQueueBytes)
+	socketHighWater = getattr (app.config, 'PROCESS_SOCKET_HIGH_WATER', socketHighWater)
+	outputWindow = getattr (app.config, 'PROCESS_OUTPUT_WINDOW', outputWindow)
+	outputBatchBytes = getattr (app.config, 'PROCESS_OUTPUT_BATCH_BYTES', outputBatchBytes)
+	# Channels the user’s SSH connections can carry, one is used by SFTP.
+	sshChannels = getattr (app.config, 'SSH_MAX_CONNECTIONS', 3) \
+			* getattr (app.config, 'SSH_MAX_CHANNELS', 10) - 1
+	perUser = getattr (app.config, 'PROCESS_USER_LIMIT', sshChannels)
+	if perUser > sshChannels:
+		raise ValueError (f'PROCESS_USER_LIMIT ({perUser}) exceeds available '
+				f'SSH channels ({sshChannels})')
+	scheduler = ProcessScheduler (
+			perUser=perUser,
+			total=getattr (app.config, 'PROCESS_TOTAL_LIMIT', 1024))
+	batchConcurrency = getattr (app.config, 'PROCESS_BATCH_CONCURRENCY', batchConcurrency)
+	batchMaxSize = getattr (app.config, 'PROCESS_BATCH_MAX_SIZE', batchMaxSize)
+	spoolDir = getattr (app.config, 'PROCESS_SPOOL_DIR', spoolDir)
+	spoolMaxBytes = getattr (app.config, 'PROCESS_SPOOL_MAX_BYTES', spoolMaxBytes)
+	spoolKeep = getattr (app.config, 'PROCESS_SPOOL_KEEP', spoolKeep)
+	if spoolDir:
+		os.makedirs (spoolDir, mode=0o700, exist_ok=True)
+		os.chmod (spoolDir, 0o700)
+		# left over from a previous run
+		for f in os.listdir (spoolDir):
+			if f.endswith ('.spool'):
+				os.unlink (os.path.join (spoolDir, f))
 
 	cleanupThread = asyncio.ensure_future (cleanupJob ())
 
@@ -294,5 +949,13 @@ async def teardown (app, loop):
 			await cleanupThread
 		except asyncio.CancelledError:
 			pass
+	for starting in list (perUserStarting.values ()):
+		for task in list (starting.values ()):
+			if task is not None:
+				task.cancel ()
+	for spools in perUserSpools.values ():
+		for spool in spools.values ():
+			spool.close ()
+	perUserSpools.clear ()
 
 
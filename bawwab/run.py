@@ -84,7 +84,9 @@ def loganalyze ():
 def passwd ():
 	""" Change UNIX password for a user.
 
-	This is required if the password changed on the backend
+	This is required if the password changed on the backend. A running
+	server picks up the new password when its cached user expires or the old
+	one is rejected.
 	"""
 
 	import asyncio
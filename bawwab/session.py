@@ -22,8 +22,8 @@
 Simple session middleware
 """
 
-import asyncio
-from datetime import timedelta
+import asyncio, json as jsonlib, zlib
+from datetime import timedelta, datetime
 
 from tortoise.models import Model
 from tortoise import fields
@@ -33,10 +33,14 @@ from sanic import Blueprint
 from sanic.response import json, redirect
 from sanic.exceptions import Forbidden, ServerError
 from furl import furl
+import aiohttp
+from cryptography.fernet import Fernet, InvalidToken
 from structlog import get_logger
+import pytz
 
-from .util import now, randomSecret, periodic
+from .util import now, randomSecret, periodic, LruCache
 from .oauth2 import KeycloakClient, Oauth2Error
+from .user import prewarm
 
 logger = get_logger ()
 # do not change this value unless you know how to migrate your database
@@ -56,8 +60,201 @@ class Session (Model):
 		else:
 			raise AttributeError ()
 
+class RevokedSession (Model):
+	name = fields.CharField(sessionNameLen, unique=True, description='Revoked stateless session id')
+	revoked = fields.DatetimeField(auto_now_add=True)
+
+# Stateless sessions expire after this time without access, just like
+# database-backed ones are removed by expireJob.
+cookieSessionTtl = 24*60*60
+# Reissue the cookie after this time, so active sessions do not expire.
+cookieSessionRefresh = 10*60
+# Only these keys of oauthInfo are kept in the cookie, since its size is
+# limited.
+cookieOauthInfoKeys = ('sub', 'name', 'preferred_username', 'given_name',
+		'family_name', 'email', 'email_verified')
+
+class CookieSession:
+	"""
+	Session stored in an encrypted cookie instead of the database. It behaves
+	like Session, but .save() only marks it modified and saveSession sends
+	it to the client.
+	"""
+
+	__slots__ = ('name', 'created', 'accessed', 'oauthState', 'oauthInfo',
+			'issued', 'modified')
+
+	def __init__ (self, name, created, oauthState=None, oauthInfo=None, issued=None):
+		self.name = name
+		self.created = created
+		self.accessed = now ()
+		self.oauthState = oauthState
+		self.oauthInfo = oauthInfo
+		self.issued = issued
+		self.modified = issued is None
+
+	@property
+	def authId (self):
+		if self.oauthInfo and 'sub' in self.oauthInfo:
+			return self.oauthInfo['sub']
+		else:
+			raise AttributeError ()
+
+	async def save (self, update_fields=None):
+		self.modified = True
+
+	async def delete (self):
+		await revokeSession (self.name)
+
+	@property
+	def needsRefresh (self):
+		return self.modified or \
+				(now () - self.issued).total_seconds () > cookieSessionRefresh
+
+	def encode (self, crypter):
+		oauthInfo = self.oauthInfo
+		if oauthInfo is not None:
+			oauthInfo = dict ((k, v) for k, v in oauthInfo.items () if k in cookieOauthInfoKeys)
+		payload = dict (
+				n=self.name,
+				c=int (self.created.timestamp ()),
+				s=self.oauthState,
+				i=oauthInfo,
+				)
+		return crypter.encrypt (jsonlib.dumps (payload).encode ('utf-8')).decode ('ascii')
+
+	@classmethod
+	def decode (cls, crypter, token):
+		""" Decode a cookie value, return None if it is invalid or expired """
+		try:
+			token = token.encode ('ascii')
+			payload = jsonlib.loads (crypter.decrypt (token, ttl=cookieSessionTtl))
+			issued = crypter.extract_timestamp (token)
+		except (InvalidToken, UnicodeError, ValueError):
+			return None
+		return cls (name=payload['n'],
+				created=datetime.fromtimestamp (payload['c'], tz=pytz.utc),
+				oauthState=payload['s'],
+				oauthInfo=payload['i'],
+				issued=datetime.fromtimestamp (issued, tz=pytz.utc))
+
+# Names of revoked stateless sessions. Synchronized with the database by
+# revocationJob, so other processes learn about revocations as well.
+revokedSessions = set ()
+
+async def revokeSession (name):
+	try:
+		await RevokedSession (name=name).save ()
+	except IntegrityError:
+		# already revoked
+		pass
+	revokedSessions.add (name)
+
+async def loadRevoked ():
+	names = await RevokedSession.all ().values_list ('name', flat=True)
+	revokedSessions.clear ()
+	revokedSessions.update (names)
+
+# Only a sample of stateless sessions is tracked, so getStatus can estimate
+# their number without storing every session.
+activitySampleRate = 16
+sampledActivity = dict ()
+
+def recordActivity (session):
+	if zlib.crc32 (session.name.encode ('ascii')) % activitySampleRate == 0:
+		sampledActivity[session.name] = session.accessed
+
+def estimateActive (since):
+	return activitySampleRate * sum (1 for v in sampledActivity.values () if v >= since)
+
+class AnonymousSession:
+	"""
+	Placeholder for requests without a stored session. It is read-only, use
+	ensureSession to get a modifiable session.
+	"""
+
+	__slots__ = ()
+
+	name = None
+	created = None
+	accessed = None
+	oauthState = None
+	oauthInfo = None
+
+	@property
+	def authId (self):
+		raise AttributeError ()
+
+anonymousSession = AnonymousSession ()
+
 bp = Blueprint ('session')
 
+# Pending updates of Session.accessed, written to the database in batches by
+# flushJob.
+pendingAccessed = dict ()
+# Maximum number of parameters per UPDATE, SQLite limits them.
+flushBatchSize = 500
+
+async def flushAccessed ():
+	""" Write pending accessed timestamps to the database """
+	global pendingAccessed
+
+	if not pendingAccessed:
+		return
+	pending = pendingAccessed
+	pendingAccessed = dict ()
+
+	# All timestamps are at most a few seconds apart, so a single one is
+	# good enough and allows merging them into one UPDATE.
+	accessed = max (pending.values ())
+	names = list (pending.keys ())
+	try:
+		async with in_transaction ():
+			for i in range (0, len (names), flushBatchSize):
+				await Session.filter (name__in=names[i:i+flushBatchSize]) \
+						.update (accessed=accessed)
+	except Exception:
+		# Try again next time, unless there is a newer update already.
+		for k, v in pending.items ():
+			pendingAccessed.setdefault (k, v)
+		raise
+
+def forgetSession (name):
+	""" Remove session from cache and drop pending updates """
+	sessionCache.pop (name)
+	pendingAccessed.pop (name, None)
+
+async def createSession ():
+	""" Create and store a new session with a random name """
+	if cookieCrypter is not None:
+		return CookieSession (name=randomSecret (sessionNameLen), created=now ())
+
+	for i in range (100):
+		try:
+			sid = randomSecret (sessionNameLen)
+
+			# make sure there’s no duplicates
+			session = Session (name=sid, accessed=now ())
+			await session.save ()
+			sessionCache.put (session.name, session)
+			return session
+		except IntegrityError:
+			pass
+	raise ServerError ('session')
+
+async def ensureSession (request):
+	"""
+	Get the request’s session, allocating a stored one if the request
+	does not have one yet. Handlers must call this before modifying the
+	session.
+	"""
+	session = request.ctx.session
+	if not session.name:
+		session = await createSession ()
+		request.ctx.session = session
+		request.ctx.logger.info (__name__ + '.create', session=session.name)
+	return session
+
 async def loadSession (request):
 	session = None
 	config = request.app.config
@@ -67,28 +264,34 @@ async def loadSession (request):
 		return
 
 	sessionId = request.cookies.get ('session')
-	if sessionId:
-		try:
-			session = await Session.filter (name=sessionId).first ()
-		except DoesNotExist:
-			pass
-
-	# try to create a new session if none exists yet
-	for i in range (100 if not session else 0):
-		try:
-			# create a new one
-			sid = randomSecret (sessionNameLen)
+	if cookieCrypter is not None:
+		if sessionId:
+			session = CookieSession.decode (cookieCrypter, sessionId)
+		if session is not None and session.name not in revokedSessions:
+			recordActivity (session)
+			request.ctx.session = session
+		else:
+			request.ctx.session = anonymousSession
+		return
+	elif sessionId:
+		session = sessionCache.get (sessionId)
+		if session is None:
+			try:
+				session = await Session.filter (name=sessionId).first ()
+			except DoesNotExist:
+				pass
+			if session is not None:
+				sessionCache.put (session.name, session)
 
-			# make sure there’s no duplicates
-			session = Session (name=sid)
-			await session.save ()
-			break
-		except IntegrityError:
-			session = None
 	if not session:
-		raise ServerError ('session')
+		# Stored sessions are created lazily by ensureSession, so anonymous
+		# requests never touch the database.
+		request.ctx.session = anonymousSession
+		return
+
 	session.accessed = now ()
-	await session.save (update_fields=('accessed', ))
+	# Written by flushJob, so the database is not on the critical path.
+	pendingAccessed[session.name] = session.accessed
 	request.ctx.session = session
 
 async def csrfOriginCheck (request):
@@ -114,7 +317,13 @@ async def saveSession (request, response):
 	# so it should .delete() the session object as well.
 	# XXX: can we figure out a fail-safe way to do this?
 	session = getattr (request.ctx, 'session', None)
-	if session is not None and session.name:
+	if isinstance (session, CookieSession):
+		# Avoid encrypting the session on every request.
+		if session.needsRefresh:
+			response.cookies['session'] = session.encode (cookieCrypter)
+			response.cookies['session']['httponly'] = True
+			response.cookies['session']['samesite'] = 'Lax'
+	elif session is not None and session.name:
 		response.cookies['session'] = request.ctx.session.name
 		# session cookies should never be readable by JavaScript. In case of an
 		# XSS vulnerability reading them via JavaScript is not possible.
@@ -124,16 +333,27 @@ async def saveSession (request, response):
 		# no expiraton == session cookie
 		# DO NOT .save() the session here. Session objects are long-lived and
 		# prone to race-conditions. Use .save(update_fields=…) instead.
-	else:
-		# delete session
+	elif session is None or request.cookies.get ('session'):
+		# delete session, but do not bother clients, which never had one
 		del response.cookies['session']
 
 async def getStatus ():
 	""" Get module status information """
+	if cookieCrypter is not None:
+		# Approximate, since sessions are not stored.
+		return dict (
+				active10m=estimateActive (now() - timedelta (minutes=10)),
+				total=estimateActive (now() - timedelta (seconds=cookieSessionTtl)),
+				revoked=len (revokedSessions),
+				)
+
+	# Approximate, up to len (pendingAccessed) updates are not written yet.
 	activeSince = now() - timedelta (minutes=10)
 	return dict (
 			active10m=await Session.filter (accessed__gte=activeSince).count (),
 			total=await Session.filter().count (),
+			cached=len (sessionCache),
+			pendingAccessed=len (pendingAccessed),
 			)
 
 @bp.route ('/', methods=['GET'])
@@ -142,11 +362,14 @@ async def sessionGet (request):
 
 	session = request.ctx.session
 
+	def isoformat (d):
+		return d.isoformat () if d is not None else None
+
 	session = dict (
 		name=session.name,
 		oauthInfo=session.oauthInfo,
-		created=session.created.isoformat (),
-		accessed=session.accessed.isoformat (),
+		created=isoformat (session.created),
+		accessed=isoformat (session.accessed),
 		)
 
 	return json (session, status=200)
@@ -158,7 +381,9 @@ async def sessionDelete (request):
 	session = request.ctx.session
 	request.ctx.logger.info (__name__ + '.delete', session=session.name)
 
-	await session.delete ()
+	if session.name:
+		forgetSession (session.name)
+		await session.delete ()
 	request.ctx.session = None
 
 	return json ({}, status=200)
@@ -185,6 +410,8 @@ async def login (request):
 	if session.oauthInfo:
 		return redirect (nextUrl)
 
+	session = await ensureSession (request)
+
 	# development override active?
 	config = app.config
 	isDebug = getattr (config, 'DEBUG', False)
@@ -248,45 +475,91 @@ async def callback (request):
 		return redirect ('/login/oauth2_' + e.args[0])
 
 	session.oauthInfo = userinfo
-	await session.save (update_fields=('oauthInfo', ))
+	try:
+		await session.save (update_fields=('oauthInfo', ))
+	except Exception:
+		# Do not serve a logged in session from the cache, which the
+		# database does not know about.
+		sessionCache.pop (session.name)
+		raise
 
 	request.ctx.logger.info (__name__ + '.login.success',
 			authId=session.authId, session=session.name)
 
+	# The browser will ask for the user soon.
+	prewarm (session.authId)
+
 	return redirect (nextUrl)
 
 @bp.route ('/logout')
 async def logout (request):
-    u = auth.logoutUrl
+    u = await auth.getUrl ('logout')
     next = request.args.get ('next')
     if next:
         u.set (args={'redirect_uri': next})
     return redirect (str (u))
 
 expireJobThread = None
+flushJobThread = None
+revocationJobThread = None
 auth = None
+httpSession = None
+sessionCache = None
+cookieCrypter = None
 
 hour = 60*60
 @periodic(1*hour)
 async def expireJob ():
+	# Make sure the database has recent access times.
+	await flushAccessed ()
 
 	oldest = now() - timedelta (days=1)
 	async for s in Session.filter (accessed__lte=oldest):
 		logger.info (__name__ + '.expire', session=s.name)
+		forgetSession (s.name)
 		await s.delete ()
 
+	# Revoked cookies are rejected because of their age after this time.
+	oldest = now() - timedelta (seconds=cookieSessionTtl + cookieSessionRefresh)
+	await RevokedSession.filter (revoked__lte=oldest).delete ()
+	for k, v in list (sampledActivity.items ()):
+		if v < oldest:
+			sampledActivity.pop (k)
+
+@periodic(10)
+async def revocationJob ():
+	await loadRevoked ()
+
+@periodic(5)
+async def flushJob ():
+	await flushAccessed ()
+
 @bp.listener('before_server_start')
 async def setup (app, loop):
-	global expireJobThread, auth
+	global expireJobThread, flushJobThread, revocationJobThread, auth, \
+			httpSession, sessionCache, cookieCrypter
 
 	config = app.config
 
+	# bawwab runs as a single process, so cached sessions are the
+	# authoritative copy and handlers may modify and .save() them as usual.
+	sessionCache = LruCache (getattr (config, 'SESSION_CACHE_SIZE', 10000))
+	if getattr (config, 'SESSION_STATELESS', False):
+		cookieCrypter = Fernet (config.SESSION_COOKIE_KEY)
+		revocationJobThread = asyncio.ensure_future (revocationJob ())
 	expireJobThread = asyncio.ensure_future (expireJob ())
+	flushJobThread = asyncio.ensure_future (flushJob ())
+	# Shared by all OAuth requests, so connections to the server are reused.
+	httpSession = aiohttp.ClientSession (
+			connector=aiohttp.TCPConnector (limit=getattr (config, 'OAUTH_POOL_SIZE', 20)),
+			timeout=aiohttp.ClientTimeout (total=30))
 	auth = KeycloakClient (
 			id=config.CLIENT_ID,
 			secret=config.CLIENT_SECRET,
 			baseUrl=config.KEYCLOAK_BASE,
-			realm=config.KEYCLOAK_REALM)
+			realm=config.KEYCLOAK_REALM,
+			http=httpSession,
+			verifyIdToken=getattr (config, 'OAUTH_VERIFY_ID_TOKEN', False))
 
 	# @bp.middleware attaches to blueprint’s url only, but we need it
 	# application-wide.
@@ -297,12 +570,21 @@ async def setup (app, loop):
 	app.register_middleware (csrfOriginCheck, 'request')
 	app.register_middleware (saveSession, 'response')
 
+@bp.listener('before_server_stop')
+async def flushPending (app, loop):
+	# Database connections are closed after the server stopped.
+	await flushAccessed ()
+
 @bp.listener('after_server_stop')
 async def teardown (app, loop):
-	if expireJobThread:
-		expireJobThread.cancel ()
-		try:
-			await expireJobThread
-		except asyncio.CancelledError:
-			pass
+	for t in (expireJobThread, flushJobThread, revocationJobThread):
+		if t:
+			t.cancel ()
+			try:
+				await t
+			except asyncio.CancelledError:
+				pass
+
+	if httpSession:
+		await httpSession.close ()
 
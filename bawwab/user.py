@@ -22,7 +22,7 @@
 User management.
 """
 
-import asyncio, shlex, json, itertools
+import asyncio, shlex, json, itertools, time, heapq, sys, hashlib, bisect, os
 from asyncio.subprocess import PIPE
 from functools import wraps
 from datetime import timedelta
@@ -36,12 +36,11 @@ from sanic import Blueprint
 from sanic.response import html
 from sanic.response import json as sanicjson
 from sanic.exceptions import Forbidden, ServerError, NotFound, ServiceUnavailable
-import aiohttp
 from cryptography.fernet import Fernet
 import asyncssh
 from structlog import get_logger
 
-from .util import randomSecret, now, periodic
+from .util import randomSecret, now, LruCache
 
 logger = get_logger ()
 
@@ -51,6 +50,127 @@ class TermsNotAccepted (Exception):
 	""" User did not agree to terms of service yet """
 	pass
 
+class CircuitOpen (ServiceUnavailable):
+	""" Connecting to the SSH host failed too often recently """
+	pass
+
+class ChannelsExhausted (ServiceUnavailable):
+	""" All of the user’s connections carry the maximum number of channels """
+	pass
+
+class CircuitBreaker:
+	"""
+	Fail fast when a host is down.
+
+	After threshold consecutive connection failures the breaker opens and
+	rejects all attempts for timeout seconds. Then a single probe is let
+	through (half-open), which closes the breaker if it succeeds or opens it
+	again.
+	"""
+
+	def __init__ (self, host, threshold=5, timeout=30):
+		self.host = host
+		self.threshold = threshold
+		self.timeout = timeout
+		self.failures = 0
+		self.openedAt = None
+		self.probing = False
+		self.logger = logger.bind (host=host)
+
+	@property
+	def state (self):
+		if self.openedAt is None:
+			return 'closed'
+		elif self.probing or asyncio.get_running_loop ().time () - self.openedAt < self.timeout:
+			return 'open'
+		else:
+			return 'halfOpen'
+
+	def check (self):
+		""" Raise CircuitOpen, unless a connection attempt is allowed """
+		state = self.state
+		if state == 'open':
+			raise CircuitOpen ('unavailable')
+		elif state == 'halfOpen':
+			self.probing = True
+
+	def success (self):
+		if self.openedAt is not None:
+			self.logger.info (__name__ + '.breaker.close')
+		self.failures = 0
+		self.openedAt = None
+		self.probing = False
+
+	def failure (self):
+		self.failures += 1
+		if self.openedAt is not None or self.failures >= self.threshold:
+			if self.openedAt is None:
+				self.logger.error (__name__ + '.breaker.open', failures=self.failures)
+			self.openedAt = asyncio.get_running_loop ().time ()
+		self.probing = False
+
+	def abort (self):
+		""" Attempt ended without telling us anything about the host """
+		self.probing = False
+
+	def toDict (self):
+		return dict (state=self.state, failures=self.failures)
+
+class HashRing:
+	"""
+	Consistent hashing of keys onto nodes, so adding or removing a node only
+	moves few keys.
+	"""
+
+	def __init__ (self, nodes, replicas=100):
+		self.nodes = list (nodes)
+		self._ring = sorted ((self._hash (f'{n}#{i}'), n) for n in self.nodes for i in range (replicas))
+		self._hashes = [h for h, n in self._ring]
+
+	@staticmethod
+	def _hash (s):
+		# Must be stable across restarts, so no hash()
+		return int.from_bytes (hashlib.blake2b (s.encode ('utf-8'), digest_size=8).digest (), 'big')
+
+	def lookup (self, key):
+		""" Get all nodes, most preferred for key first """
+		ret = []
+		start = bisect.bisect (self._hashes, self._hash (key))
+		for i in range (len (self._ring)):
+			n = self._ring[(start + i) % len (self._ring)][1]
+			if n not in ret:
+				ret.append (n)
+				if len (ret) == len (self.nodes):
+					break
+		return ret
+
+class KnownHostsCache:
+	"""
+	known_hosts file, parsed once and shared by all connections. It is
+	reloaded when its modification time changes.
+	"""
+
+	def __init__ (self, path):
+		self.path = path
+		self._mtime = None
+		self._knownHosts = None
+
+	def get (self):
+		""" Get value suitable for asyncssh’s known_hosts option """
+		if self.path is None:
+			return None
+
+		try:
+			mtime = os.stat (self.path).st_mtime_ns
+		except OSError:
+			# Let asyncssh report the error.
+			return self.path
+		if mtime != self._mtime:
+			logger.info (__name__ + '.knownHosts.load', path=self.path)
+			self._knownHosts = asyncssh.read_known_hosts (self.path)
+			self._mtime = mtime
+		return self._knownHosts
+
 # In asyncio terminology this is a Protocol?
 class BawwabSSHClient (asyncssh.SSHClient):
 	def __init__ (self, user, acceptTos=False):
@@ -59,6 +179,10 @@ class BawwabSSHClient (asyncssh.SSHClient):
 		self.motd = None
 		self.acceptTos = acceptTos
 		self.conn = None
+		# Set when the connection is closed or keepalives time out
+		self.lost = False
+		# Called when the connection is lost
+		self.onLost = None
 
 	def connection_made (self, conn):
 		self.conn = conn
@@ -68,7 +192,9 @@ class BawwabSSHClient (asyncssh.SSHClient):
 		conn.bclient = self
 
 	def connection_lost (self, exc):
-		pass
+		self.lost = True
+		if self.onLost is not None:
+			self.onLost ()
 
 	def auth_banner_received (self, msg, lang):
 		pass
@@ -118,15 +244,22 @@ class UserConnection:
 	channels, as well as its last usage.
 	"""
 
-	def __init__ (self, conn):
+	def __init__ (self, conn, host):
 		self.conn = conn
+		self.host = host
 		self.sftpConn = None
 		self.sftpLock = asyncio.Lock ()
+		# An operation failed, check the SFTP channel before using it again
+		self.sftpSuspect = False
 		self.processes = []
 		self.processLock = asyncio.Lock ()
+		# Channels being opened right now
+		self.openingChannels = 0
 
 		# Can we use this connection? For the connection manager (urgh)
 		self.usable = True
+		# Established speculatively and not used yet
+		self.speculative = False
 
 		self.loop = asyncio.get_running_loop ()
 		self.lastUse = self.loop.time ()
@@ -142,8 +275,21 @@ class UserConnection:
 		else:
 			return self.lastUse
 
+	@property
+	def alive (self):
+		""" Connection is still open, as far as we know """
+		return self.conn is not None and not self.conn.bclient.lost
+
+	@property
+	def channels (self):
+		""" Number of open (or opening) channels """
+		self.processes = list (filter (lambda x: not x.is_closing (), self.processes))
+		return len (self.processes) + self.openingChannels + \
+				(1 if self.sftpConn is not None else 0)
+
 	@classmethod
-	async def connect (cls, host, user, knownHosts=None, acceptTos=False):
+	async def connect (cls, host, user, knownHosts=None, acceptTos=False,
+			keepaliveInterval=30, keepaliveCountMax=3):
 		conn = await asyncssh.connect (
 				client_factory=lambda: BawwabSSHClient (user, acceptTos),
 				host=host,
@@ -152,11 +298,14 @@ class UserConnection:
 				password=user.password,
 				options=asyncssh.SSHClientConnectionOptions (
 						known_hosts=knownHosts,
+						# Detect dead connections without probing them.
+						keepalive_interval=keepaliveInterval,
+						keepalive_count_max=keepaliveCountMax,
 						# Disable GSS auth. Otherwise usermgr’s cached (and most likely expired)
 						# credentials will be used. We always use password authentication.
 						gss_auth=False, gss_kex=False),
 				)
-		return cls (conn)
+		return cls (conn, host)
 
 	async def close (self):
 		async with self.sftpLock:
@@ -173,7 +322,11 @@ class UserConnection:
 	async def getMotd (self):
 		self.lastUse = self.loop.time ()
 
-		stdin, stdout, stderr = await self.conn.open_session ()
+		self.openingChannels += 1
+		try:
+			stdin, stdout, stderr = await self.conn.open_session ()
+		finally:
+			self.openingChannels -= 1
 
 		try:
 			return await asyncio.wait_for (stdout.read (64*1024), timeout=0.5)
@@ -185,63 +338,227 @@ class UserConnection:
 
 		async with self.sftpLock:
 			if self.sftpConn is not None:
-				# There is no way to check the status of a connection, so
-				# try an operation to see if it’s still alive.
-				await self.sftpConn.getcwd ()
+				if self.sftpSuspect:
+					# There is no way to check the status of the channel, so
+					# try an operation to see if it’s still alive. The
+					# connection itself is covered by keepalives.
+					self.sftpSuspect = False
+					await self.sftpConn.getcwd ()
 			else:
-				self.sftpConn = LastUseProxy (await self.conn.start_sftp_client ())
+				self.openingChannels += 1
+				try:
+					self.sftpConn = LastUseProxy (await self.conn.start_sftp_client ())
+				finally:
+					self.openingChannels -= 1
 
 			return self.sftpConn
 
 	async def createProcess (self, *args):
 		self.lastUse = self.loop.time ()
 
-		async with self.processLock:
-			p = await self.conn.create_process (shlex.join (args))
-			self.processes.append (p)
-			return p
+		self.openingChannels += 1
+		try:
+			async with self.processLock:
+				p = await self.conn.create_process (shlex.join (args))
+				self.processes.append (p)
+				return p
+		finally:
+			self.openingChannels -= 1
 
 class UserConnectionManager:
 	"""
 	Manage per-user SSH connection.
 
-	A user can have multiple open connections, but only the most
-	recent one is exposed. Connections are automatically closed
-	when idle.
+	A user can have a small pool of connections. New channels are opened on
+	the least-loaded connection and another connection is established only
+	if all of them carry maxChannels channels already. Connections are
+	automatically closed when idle.
+
+	Users are placed onto one of hosts by consistent hashing of their name,
+	falling back to the next host if its circuit breaker is open.
 	"""
 
-	def __init__ (self, host, knownHosts):
+	def __init__ (self, hosts, knownHosts, maxChannels=10, maxConnections=3,
+			connectArgs=None, breakerArgs=None):
 		self._conns = defaultdict (list)
 		self._locks = defaultdict (asyncio.Lock)
-		self.host = host
-		self.knownHosts = knownHosts
+		# In-flight connection attempts, user → task
+		self._connecting = dict ()
+		self._prewarming = dict ()
+		# Heap of (loop time, sequence, user, connection), checked by expireJob
+		self._deadlines = []
+		self._deadlineSeq = itertools.count ()
+		self._wakeup = asyncio.Event ()
+		# Idle connections are closed after this time
+		self.maxIdle = 10*60
+		# Speculative connections are closed after this time, if unused
+		self.prewarmIdle = 60
+		# Recheck connections with open channels after this time
+		self.busyRecheck = 60
+		self.hosts = HashRing (hosts)
+		self.knownHosts = KnownHostsCache (knownHosts)
+		# Should be at most sshd’s MaxSessions
+		self.maxChannels = maxChannels
+		self.maxConnections = maxConnections
+		# Additional arguments for UserConnection.connect
+		self.connectArgs = connectArgs or dict ()
+		self.breakers = dict ((h, CircuitBreaker (h, **(breakerArgs or dict ()))) for h in hosts)
 		self.logger = logger.bind ()
 
-	async def getConnection (self, user, useNewConnection=False, acceptTos=False):
-		userconns = self._conns[user]
-		if len (userconns) == 0 or useNewConnection or not userconns[0].usable:
-			# Mark other connections as unusable, so even
-			# if we GC this new one we will not fall back to
-			# the other ones.
-			for c in userconns:
-				c.usable = False
-			c = await UserConnection.connect (self.host, user, self.knownHosts, acceptTos=acceptTos)
-			userconns.insert (0, c)
-		return userconns[0]
+	def _pick (self, user, sftp=False):
+		"""
+		Pick the least loaded usable connection, which can open another
+		channel, or None.
+
+		All SFTP requests should share a single SFTP channel, so prefer
+		connections with an open one.
+		"""
+		conns = [c for c in self._conns.get (user, ()) if c.usable and c.alive]
+		if sftp:
+			for c in conns:
+				if c.sftpConn is not None:
+					return c
+		conns = [c for c in conns if c.channels < self.maxChannels]
+		if conns:
+			return min (conns, key=lambda c: c.channels)
+		return None
+
+	async def getConnection (self, user, acceptTos=False, stale=None, sftp=False,
+			speculative=False):
+		"""
+		Get a connection for user, connecting if necessary.
+
+		Concurrent callers share a single connection attempt. stale is a
+		connection the caller found to be broken, it will not be used again.
+		"""
+		c = await self._getConnection (user, acceptTos, stale, sftp, speculative)
+		if not speculative:
+			c.speculative = False
+		return c
+
+	async def _getConnection (self, user, acceptTos, stale, sftp, speculative):
+		if stale is not None:
+			stale.usable = False
+
+		if not acceptTos:
+			c = self._pick (user, sftp)
+			if c is not None:
+				return c
+
+			usable = [c for c in self._conns.get (user, ()) if c.usable and c.alive]
+			if len (usable) >= self.maxConnections:
+				# The server would refuse to open more channels.
+				raise ChannelsExhausted ('busy')
+
+			# Accepting the terms of service changes the login, so do not
+			# share these attempts.
+			pending = self._connecting.get (user)
+			if pending is not None:
+				return await asyncio.shield (pending)
+
+		task = asyncio.ensure_future (self._connect (user, acceptTos, speculative))
+		if not acceptTos:
+			self._connecting[user] = task
+			def done (t):
+				if self._connecting.get (user) is t:
+					self._connecting.pop (user)
+				# Avoid warnings, if all waiters are gone.
+				if not t.cancelled ():
+					t.exception ()
+			task.add_done_callback (done)
+		return await asyncio.shield (task)
+
+	def prewarm (self, user):
+		"""
+		Connect user and start SFTP in the background, so the handshake does
+		not delay the first request. Does nothing if the user is connected
+		already.
+		"""
+		if self._conns.get (user) or user in self._connecting or user in self._prewarming:
+			return
+
+		async def run ():
+			try:
+				c = await self.getConnection (user, sftp=True, speculative=True)
+				await c.getSftp ()
+			except Exception as e:
+				# The real request will report the error.
+				self.logger.info ('connmgr.prewarm.failed', user=user, error=str (e))
+
+		async def runWithTimeout ():
+			try:
+				await asyncio.wait_for (run (), timeout=self.prewarmIdle)
+			except asyncio.TimeoutError:
+				self.logger.info ('connmgr.prewarm.timeout', user=user)
+			finally:
+				self._prewarming.pop (user, None)
+
+		self._prewarming[user] = asyncio.ensure_future (runWithTimeout ())
+
+	def place (self, user):
+		""" Get host for new connections of user """
+		for host in self.hosts.lookup (user.name):
+			if self.breakers[host].state != 'open':
+				return host
+		raise CircuitOpen ('unavailable')
+
+	async def _connect (self, user, acceptTos, speculative=False):
+		host = self.place (user)
+		breaker = self.breakers[host]
+		breaker.check ()
+		try:
+			c = await UserConnection.connect (host, user, self.knownHosts.get (),
+					acceptTos=acceptTos, **self.connectArgs)
+		except asyncssh.misc.PermissionDenied:
+			# The host is fine.
+			breaker.success ()
+			# The password might have been changed by bawwab-passwd,
+			# reload the user from the database next time.
+			forgetUser (user)
+			raise
+		except TermsNotAccepted:
+			breaker.success ()
+			raise
+		except (OSError, asyncio.TimeoutError, asyncssh.misc.ConnectionLost):
+			breaker.failure ()
+			raise
+		except BaseException:
+			breaker.abort ()
+			raise
+		breaker.success ()
+		c.speculative = speculative
+		self._conns[user].append (c)
+		loop = asyncio.get_running_loop ()
+		self._schedule (user, c, self._nextDeadline (c, loop.time ()))
+		c.conn.bclient.onLost = lambda: self._schedule (user, c, loop.time ())
+		self.logger.info ('connmgr.connect', user=user, host=host, conns=len (self._conns[user]))
+		return c
 
 	async def withConnection (self, f, *args, **kwargs):
 		"""
 		Use a connection with one retry, return the result of f.
 
-		Retries all asyncssh SSH and SFTP errors.
+		Retries all asyncssh SSH and SFTP errors, except for failed
+		authentication, which would just fail again. A refused channel means
+		the connection is full, not broken, and raises ChannelsExhausted.
 		"""
 		try:
 			c = await self.getConnection (*args, **kwargs)
-			return await f (c)
-		except (asyncssh.misc.Error, asyncssh.sftp.SFTPError):
-			kwargs['useNewConnection'] = True
+		except asyncssh.misc.PermissionDenied:
+			raise
+		except asyncssh.misc.Error:
 			c = await self.getConnection (*args, **kwargs)
+
+		try:
 			return await f (c)
+		except asyncssh.misc.ChannelOpenError:
+			raise ChannelsExhausted ('busy')
+		except (asyncssh.misc.Error, asyncssh.sftp.SFTPError):
+			c = await self.getConnection (*args, stale=c, **kwargs)
+			try:
+				return await f (c)
+			except asyncssh.misc.ChannelOpenError:
+				raise ChannelsExhausted ('busy')
 
 	async def getMotd (self, user):
 		async def f (c):
@@ -251,52 +568,113 @@ class UserConnectionManager:
 	async def getSftp (self, user):
 		async def f (c):
 			return await c.getSftp ()
-		return await self.withConnection (f, user)
+		return await self.withConnection (f, user, sftp=True)
 
-	async def createProcess (self, user, *args, useNewConnection=False):
+	async def createProcess (self, user, *args):
 		async def f (c):
 			return await c.createProcess (*args)
-		return await self.withConnection (f, user, useNewConnection=useNewConnection)
+		return await self.withConnection (f, user)
 
 	async def acceptTos (self, user):
-		c = await self.getConnection (user, useNewConnection=True, acceptTos=True)
+		c = await self.getConnection (user, acceptTos=True)
 		return True
 
+	def sftpFailed (self, user):
+		""" An SFTP operation failed, check channels before using them again """
+		for c in self._conns.get (user, []):
+			c.sftpSuspect = True
+
 	async def disconnect (self, user):
+		# do not create entries for users without connections
+		if user not in self._conns:
+			return
 		async with self._locks[user]:
-			for c in self._conns[user]:
+			for c in self._conns.get (user, ()):
 				await c.close ()
 
-	async def cleanup (self):
-		""" Clean up idle and dead connections """
-		self.logger.info ('connmgr.cleanup.start', conns=len (self._conns))
-		loop = asyncio.get_running_loop ()
-		now = loop.time ()
-		maxIdle = 10*60
-		for k in list (self._conns.keys ()):
-			purgeLock = False
-			async with self._locks[k]:
-				conns = self._conns[k]
-				alive = []
-				for c in conns:
-					if now - c.getLastUse () > maxIdle:
-						await c.close ()
-					else:
-						alive.append (c)
-				if len (alive) == 0:
-					self.logger.info ('connmgr.cleanup.purge', user=k)
-					del self._conns[k]
+	def _schedule (self, user, c, deadline):
+		""" Check connection c of user for expiry at loop time deadline """
+		heapq.heappush (self._deadlines, (deadline, next (self._deadlineSeq), user, c))
+		if self._deadlines[0][3] is c:
+			# expireJob might sleep longer
+			self._wakeup.set ()
+
+	def _nextDeadline (self, c, now):
+		lastUse = c.getLastUse ()
+		if c.processes:
+			# We cannot observe when processes exit, so check regularly.
+			return now + self.busyRecheck
+		return lastUse + (self.prewarmIdle if c.speculative else self.maxIdle)
+
+	async def _expire (self, user, c, now):
+		if c not in self._conns.get (user, ()):
+			# already expired by another entry
+			return
+
+		# Last use is updated without touching the heap, so recheck.
+		deadline = self._nextDeadline (c, now)
+		if c.alive and deadline > now:
+			self._schedule (user, c, deadline)
+			return
+
+		purgeLock = False
+		async with self._locks[user]:
+			await c.close ()
+			conns = self._conns.get (user)
+			if conns is not None:
+				if c in conns:
+					conns.remove (c)
+				if not conns:
+					del self._conns[user]
 					purgeLock = True
-				else:
-					self.logger.info ('connmgr.cleanup.alive', user=k, conns=len (alive))
-					self._conns[k] = alive
-			if purgeLock:
-				del self._locks[k]
+		self.logger.info ('connmgr.expire', user=user, purge=purgeLock)
+		if purgeLock:
+			self._locks.pop (user, None)
+
+	async def expireJob (self):
+		"""
+		Close idle and dead connections. Sleeps until the earliest deadline
+		is due or an earlier one is scheduled.
+		"""
+		loop = asyncio.get_running_loop ()
+		while True:
+			now = loop.time ()
+			while self._deadlines and self._deadlines[0][0] <= now:
+				_, _, user, c = heapq.heappop (self._deadlines)
+				try:
+					await self._expire (user, c, now)
+				except Exception:
+					_, _, exc_info = sys.exc_info ()
+					self.logger.error ('connmgr.expire.failed', user=user, exc_info=exc_info)
+
+			self._wakeup.clear ()
+			timeout = self._deadlines[0][0] - now if self._deadlines else None
+			try:
+				await asyncio.wait_for (self._wakeup.wait (), timeout=timeout)
+			except asyncio.TimeoutError:
+				pass
 
 	async def close (self):
+		for t in list (self._prewarming.values ()):
+			t.cancel ()
 		for c in itertools.chain.from_iterable (self._conns.values ()):
 			await c.close ()
 
+	def available (self, user):
+		""" Connecting user is not rejected """
+		try:
+			self.place (user)
+			return True
+		except CircuitOpen:
+			return False
+
+	def hostStatus (self):
+		""" Per-host connection count and breaker state """
+		ret = dict ((h, dict (connections=0, breaker=b.toDict ())) for h, b in self.breakers.items ())
+		for c in itertools.chain.from_iterable (self._conns.values ()):
+			ret[c.host]['connections'] += 1
+		return ret
+
 	@property
 	def connectionCount (self):
 		return sum (map (len, self._conns.values ()))
@@ -305,8 +683,113 @@ class UserConnectionManager:
 	def userCount (self):
 		return len (self._conns)
 
+class CommandRunner:
+	"""
+	Run local commands with a global concurrency limit and a timeout, so
+	registration spikes do not fork hundreds of processes at once.
+	"""
+
+	def __init__ (self, concurrency=4, timeout=60):
+		self.semaphore = asyncio.Semaphore (concurrency)
+		self.timeout = timeout
+		# statistics
+		self.waiting = 0
+		self.running = 0
+		self.completed = 0
+		self.timeouts = 0
+		self.waitTime = 0
+		self.runTime = 0
+
+	async def run (self, command, input=None):
+		"""
+		Run command, write input to its stdin and return its stdout.
+		Raises asyncio.TimeoutError if it does not finish in time.
+		"""
+		loop = asyncio.get_running_loop ()
+		queued = loop.time ()
+		self.waiting += 1
+		try:
+			await self.semaphore.acquire ()
+		finally:
+			self.waiting -= 1
+
+		started = loop.time ()
+		self.waitTime += started - queued
+		self.running += 1
+		proc = None
+		try:
+			proc = await asyncio.create_subprocess_exec (*command, stdin=PIPE, stdout=PIPE)
+			# Reads and writes concurrently, so a full pipe cannot block us.
+			stdout, stderr = await asyncio.wait_for (proc.communicate (input),
+					timeout=self.timeout)
+			return stdout
+		except asyncio.TimeoutError:
+			self.timeouts += 1
+			raise
+		finally:
+			if proc is not None and proc.returncode is None:
+				proc.kill ()
+				await proc.wait ()
+			self.running -= 1
+			self.completed += 1
+			self.runTime += loop.time () - started
+			self.semaphore.release ()
+
+	def toDict (self):
+		return dict (
+				waiting=self.waiting,
+				running=self.running,
+				completed=self.completed,
+				timeouts=self.timeouts,
+				avgWaitTime=self.waitTime/self.completed if self.completed else None,
+				avgRunTime=self.runTime/self.completed if self.completed else None,
+				)
+
+class CredentialCache:
+	"""
+	Decrypted passwords, keyed by their ciphertext, so they do not have to be
+	decrypted for every connection and login prompt. The plaintext is kept in
+	a bytearray, which is overwritten when it leaves the cache.
+	"""
+
+	def __init__ (self, crypter, maxSize=10000, ttl=10*60):
+		self.crypter = crypter
+		self._cache = LruCache (maxSize, ttl=ttl, onEvict=self._wipe)
+		self._purged = time.monotonic ()
+
+	@staticmethod
+	def _wipe (key, value):
+		value[:] = bytes (len (value))
+
+	def _purge (self):
+		# Make sure expired passwords do not linger around.
+		if time.monotonic () - self._purged > 60:
+			self._purged = time.monotonic ()
+			self._cache.purge ()
+
+	def get (self, ciphertext):
+		self._purge ()
+		plaintext = self._cache.get (ciphertext)
+		if plaintext is None:
+			plaintext = bytearray (self.crypter.decrypt (ciphertext))
+			self._cache.put (ciphertext, plaintext)
+		return plaintext.decode ('utf-8')
+
+	def put (self, ciphertext, password):
+		self._purge ()
+		self._cache.put (ciphertext, bytearray (password.encode ('utf-8')))
+
+	def forget (self, ciphertext):
+		plaintext = self._cache.pop (ciphertext)
+		if plaintext is not None:
+			self._wipe (ciphertext, plaintext)
+
+	def __len__ (self):
+		return len (self._cache)
+
 class User (Model):
 	crypter = None
+	credentials = None
 
 	authId = fields.CharField (128, null=True, unique=True, description='OAuth identity')
 	name = fields.CharField (64, description='UNIX user name')
@@ -319,21 +802,29 @@ class User (Model):
 		return repr (self)
 
 	@classmethod
-	def setup (cls, key):
+	def setup (cls, key, credentialTtl=10*60):
 		# Obviously this is security through obscurity. But we want to make sure
 		# that someone with access to the database cannot gain SSH access unless he
 		# also has access to this application, which would be game over anyway. It
 		# would be nice if we could encrypt it with the user’s password, but – you
 		# know – OAuth.
 		cls.crypter = Fernet (key)
+		cls.credentials = CredentialCache (cls.crypter, ttl=credentialTtl)
 
 	@property
 	def password (self):
-		return self.crypter.decrypt (self.passwordEncrypted).decode ('utf-8')
+		return self.credentials.get (self.passwordEncrypted)
 
 	@password.setter
 	def password (self, password):
+		if self.passwordEncrypted is not None:
+			self.credentials.forget (self.passwordEncrypted)
 		self.passwordEncrypted = self.crypter.encrypt (password.encode ('utf-8'))
+		self.credentials.put (self.passwordEncrypted, password)
+
+	def forgetPassword (self):
+		""" Remove decrypted password from memory """
+		self.credentials.forget (self.passwordEncrypted)
 
 	async def getMotd (self):
 		return await connmgr.getMotd (self)
@@ -341,22 +832,56 @@ class User (Model):
 	async def getSftp (self):
 		return await connmgr.getSftp (self)
 
-	async def createProcess (self, *args, useNewConnection=False):
-		return await connmgr.createProcess (self, *args, useNewConnection=useNewConnection)
+	async def createProcess (self, *args):
+		return await connmgr.createProcess (self, *args)
 
 	async def acceptTos (self):
 		return await connmgr.acceptTos (self)
 
+	def prewarm (self):
+		connmgr.prewarm (self)
+
+	def sftpFailed (self):
+		connmgr.sftpFailed (self)
+
 	async def disconnect (self):
 		return await connmgr.disconnect (self)
 
+# Identity map authId → User, so authenticated requests do not hit the
+# database and all of them use the same User object.
+userCache = None
+
+async def getUser (authId):
+	""" Get User by authId or None, if it does not exist """
+	user = userCache.get (authId)
+	if user is None:
+		user = await User.get_or_none (authId=authId)
+		if user is not None:
+			userCache.put (authId, user)
+	return user
+
+def prewarm (authId):
+	""" Connect user authId in the background, if it exists """
+	async def run ():
+		try:
+			user = await getUser (authId)
+			if user is not None:
+				user.prewarm ()
+		except Exception as e:
+			logger.error (__name__ + '.prewarm.failed', authId=authId, error=str (e))
+	asyncio.ensure_future (run ())
+
+def forgetUser (user):
+	""" Remove user from the cache, must be called after modifying it """
+	userCache.pop (user.authId)
+
 def authenticated (f):
 	@wraps(f)
 	async def wrapper (request, *args, **kwds):
 		session = request.ctx.session
 		authId = getattr (session, 'authId', None)
 		if authId is not None:
-			user = await User.get_or_none (authId=authId)
+			user = await getUser (authId)
 			if user is not None:
 				request.ctx.logger = request.ctx.logger.bind (user=dict (name=user.name, authId=user.authId))
 				return await f (request, user, *args, **kwds)
@@ -368,13 +893,28 @@ async def getStatus ():
 	activeSince = now() - timedelta (days=1)
 	return dict (
 			total=await User.filter().count (),
+			cached=len (userCache),
+			credentials=len (User.credentials),
 			connmgr=dict(
 				connections=connmgr.connectionCount,
 				users=connmgr.userCount,
+				hosts=connmgr.hostStatus (),
 				),
+			usermgr=usermgr.toDict (),
 			)
 
-async def makeUserResponse (user):
+# Cached (motd, loginStatus, fetch time) per user. Entries older than
+# loginStatusFresh seconds are refreshed in the background, while the cached
+# value is still used.
+loginStatusCache = None
+loginStatusFresh = 60
+loginStatusRefresh = dict ()
+
+async def fetchLoginStatus (user):
+	"""
+	Get (motd, loginStatus) from the server. Connection failures remove
+	the cached entry and are raised.
+	"""
 	motd = None
 	loginStatus = 'unknown'
 	try:
@@ -384,6 +924,49 @@ async def makeUserResponse (user):
 		loginStatus = 'termsOfService'
 	except asyncssh.misc.PermissionDenied:
 		loginStatus = 'permissionDenied'
+	except (OSError, asyncssh.misc.Error, CircuitOpen):
+		loginStatusCache.pop (user)
+		raise
+	loginStatusCache.put (user, (motd, loginStatus, time.monotonic ()))
+	return motd, loginStatus
+
+def refreshLoginStatus (user):
+	if user in loginStatusRefresh:
+		return
+
+	async def run ():
+		try:
+			await fetchLoginStatus (user)
+		except Exception as e:
+			logger.info (__name__ + '.loginStatus.refreshFailed', user=user, error=str (e))
+		finally:
+			if loginStatusRefresh.get (user) is asyncio.current_task ():
+				loginStatusRefresh.pop (user)
+	loginStatusRefresh[user] = asyncio.ensure_future (run ())
+
+async def getLoginStatus (user):
+	cached = loginStatusCache.get (user)
+	if cached is None:
+		return await fetchLoginStatus (user)
+
+	motd, loginStatus, fetched = cached
+	if time.monotonic () - fetched > loginStatusFresh:
+		refreshLoginStatus (user)
+	return motd, loginStatus
+
+def forgetLoginStatus (user):
+	loginStatusCache.pop (user)
+	# Do not let an outdated refresh overwrite the next value.
+	t = loginStatusRefresh.pop (user, None)
+	if t is not None:
+		t.cancel ()
+
+async def makeUserResponse (user):
+	if not connmgr.available (user):
+		return sanicjson (dict (status='unavailable'), status=503)
+
+	try:
+		motd, loginStatus = await getLoginStatus (user)
 	except OSError:
 		# SSH is down
 		return sanicjson (dict (status='unavailable'), status=503)
@@ -402,7 +985,7 @@ async def userGet (request):
 
 	authId = getattr (session, 'authId', None)
 	if authId is not None:
-		user = await User.get_or_none (authId=session.authId)
+		user = await getUser (authId)
 		if user is not None:
 			return await makeUserResponse (user)
 
@@ -420,33 +1003,26 @@ async def userCreate (request):
 
 	form['authorization'] = authId
 
-	user = await User.get_or_none (authId=authId)
+	user = await getUser (authId)
 	if user is not None:
 		raise Forbidden ('exists')
 
 	try:
-		proc = await asyncio.create_subprocess_exec (*config.USERMGR_CREATE_COMMAND, stdin=PIPE, stdout=PIPE)
-
 		s = json.dumps (form)
-		proc.stdin.write (s.encode ('utf-8'))
-		await proc.stdin.drain ()
-		proc.stdin.close ()
-		await proc.stdin.wait_closed ()
-
-		await proc.wait ()
-		s = await proc.stdout.read ()
+		s = await usermgr.run (config.USERMGR_CREATE_COMMAND, s.encode ('utf-8'))
 		s = s.decode ('utf-8')
 		data = json.loads (s)
 		if data['status'] != 'ok':
 			request.ctx.logger.error (__name__ + '.create.usermgrd_error', reason=data['status'])
 			raise ServerError ('backend')
-	except aiohttp.ClientConnectionError:
-		request.ctx.logger.error (__name__ + '.create.usermgrd_connect_failure')
+	except asyncio.TimeoutError:
+		request.ctx.logger.error (__name__ + '.create.usermgrd_timeout')
 		raise ServiceUnavailable ('backend')
 
 	user = User (authId=authId, name=data['user'])
 	user.password = data['password']
 	await user.save ()
+	userCache.put (authId, user)
 
 	request.ctx.logger.info (__name__ + '.create', user=user.name)
 
@@ -455,7 +1031,10 @@ async def userCreate (request):
 @bp.route ('/acceptTos', methods=['POST'])
 @authenticated
 async def userAcceptTos (request, user):
-	await user.acceptTos ()
+	try:
+		await user.acceptTos ()
+	finally:
+		forgetLoginStatus (user)
 	return await makeUserResponse (user)
 
 @bp.route ('/', methods=['DELETE'])
@@ -468,7 +1047,7 @@ async def userDelete (request):
 	if authId is None:
 		raise Forbidden ('anonymous')
 
-	user = await User.get_or_none (authId=authId)
+	user = await getUser (authId)
 	if user is None:
 		# This is fine.
 		return sanicjson ({'status': 'ok'}, status=200)
@@ -484,6 +1063,9 @@ async def userDelete (request):
 	# Close all connections.
 	await user.disconnect ()
 
+	forgetUser (user)
+	forgetLoginStatus (user)
+	user.forgetPassword ()
 	await user.delete ()
 
 	request.ctx.logger.info (__name__ + '.delete', user=user.name)
@@ -491,19 +1073,45 @@ async def userDelete (request):
 	return sanicjson ({'status': 'ok'}, status=200)
 
 connmgr = None
+usermgr = None
 cleanupThread = None
 
 @bp.listener('before_server_start')
 async def setup (app, loop):
 	global connmgr
+	global usermgr
 	global cleanupThread
+	global userCache
+	global loginStatusCache
 
 	config = app.config
-	User.setup (config.DATABASE_PASSWORD_KEY)
-	connmgr = UserConnectionManager (host=config.SSH_HOST,
-			knownHosts=config.KNOWN_HOSTS_PATH)
+	User.setup (config.DATABASE_PASSWORD_KEY,
+			credentialTtl=getattr (config, 'CREDENTIAL_CACHE_TTL', 10*60))
+	userCache = LruCache (getattr (config, 'USER_CACHE_SIZE', 10000),
+			ttl=getattr (config, 'USER_CACHE_TTL', 5*60))
+	loginStatusCache = LruCache (getattr (config, 'LOGIN_STATUS_CACHE_SIZE', 10000),
+			ttl=10*60)
+	hosts = config.SSH_HOST
+	if isinstance (hosts, str):
+		hosts = [hosts]
+	connmgr = UserConnectionManager (hosts=hosts,
+			knownHosts=config.KNOWN_HOSTS_PATH,
+			maxChannels=getattr (config, 'SSH_MAX_CHANNELS', 10),
+			maxConnections=getattr (config, 'SSH_MAX_CONNECTIONS', 3),
+			connectArgs=dict (
+				keepaliveInterval=getattr (config, 'SSH_KEEPALIVE_INTERVAL', 30),
+				keepaliveCountMax=getattr (config, 'SSH_KEEPALIVE_COUNT_MAX', 3),
+				),
+			breakerArgs=dict (
+				threshold=getattr (config, 'SSH_BREAKER_THRESHOLD', 5),
+				timeout=getattr (config, 'SSH_BREAKER_TIMEOUT', 30),
+				))
 
-	cleanupThread = asyncio.ensure_future (cleanupJob ())
+	usermgr = CommandRunner (
+			concurrency=getattr (config, 'USERMGR_CONCURRENCY', 4),
+			timeout=getattr (config, 'USERMGR_TIMEOUT', 60))
+
+	cleanupThread = asyncio.ensure_future (connmgr.expireJob ())
 
 @bp.listener('after_server_stop')
 async def teardown (app, loop):
@@ -514,10 +1122,10 @@ async def teardown (app, loop):
 		except asyncio.CancelledError:
 			pass
 
+	for t in list (loginStatusRefresh.values ()):
+		t.cancel ()
+	loginStatusRefresh.clear ()
+
 	if connmgr:
 		await connmgr.close ()
 
-@periodic(10)
-async def cleanupJob ():
-	await connmgr.cleanup ()
-
@@ -22,9 +22,10 @@
 Various utility functions
 """
 
-import secrets, asyncio, sys
+import secrets, asyncio, sys, time
 from datetime import datetime
 from functools import wraps
+from collections import OrderedDict
 
 from structlog import get_logger
 import pytz
@@ -55,3 +56,64 @@ def periodic(delay):
 		return wrapper
 	return decorator
 
+
+class LruCache:
+	"""
+	Size-bounded cache with optional time to live in seconds. The least
+	recently used item is evicted first.
+
+	onEvict (key, value) is called for items removed because of their size
+	or age, or replaced by put.
+	"""
+
+	def __init__ (self, maxSize, ttl=None, onEvict=None):
+		self._items = OrderedDict ()
+		self.maxSize = maxSize
+		self.ttl = ttl
+		self.onEvict = onEvict
+
+	def _evict (self, key, item):
+		if self.onEvict is not None:
+			self.onEvict (key, item[0])
+
+	def get (self, key, default=None):
+		item = self._items.get (key)
+		if item is None:
+			return default
+		value, expires = item
+		if expires is not None and time.monotonic () >= expires:
+			del self._items[key]
+			self._evict (key, item)
+			return default
+		self._items.move_to_end (key)
+		return value
+
+	def put (self, key, value):
+		expires = time.monotonic () + self.ttl if self.ttl is not None else None
+		old = self._items.get (key)
+		if old is not None and old[0] is not value:
+			self._evict (key, old)
+		self._items[key] = (value, expires)
+		self._items.move_to_end (key)
+		while len (self._items) > self.maxSize:
+			self._evict (*self._items.popitem (last=False))
+
+	def pop (self, key, default=None):
+		item = self._items.pop (key, None)
+		return item[0] if item is not None else default
+
+	def purge (self):
+		""" Remove expired items """
+		if self.ttl is None:
+			return
+		now = time.monotonic ()
+		for k, item in list (self._items.items ()):
+			if now >= item[1]:
+				del self._items[k]
+				self._evict (k, item)
+
+	def clear (self):
+		self._items.clear ()
+
+	def __len__ (self):
+		return len (self._items)
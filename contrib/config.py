@@ -17,14 +17,32 @@ KEYCLOAK_REALM = 'example'
 CLIENT_ID = 'example'
 CLIENT_SECRET = 'xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx'
 SCOPE = 'example'
+# verify the ID token locally instead of querying the userinfo endpoint,
+# requires the openid scope
+#OAUTH_VERIFY_ID_TOKEN = True
+# concurrent HTTP connections to the identity provider
+#OAUTH_POOL_SIZE = 20
 
 DATABASE_URL = 'sqlite://db.sqlite3'
+# number of sessions kept in memory
+#SESSION_CACHE_SIZE = 10000
+# store sessions in an encrypted cookie instead of the database, generate a
+# key like DATABASE_PASSWORD_KEY below. Do not use the same key.
+#SESSION_STATELESS = True
+#SESSION_COOKIE_KEY = b'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+# number of users kept in memory and seconds until they are reloaded
+#USER_CACHE_SIZE = 10000
+#USER_CACHE_TTL = 5*60
+# number of users whose MOTD and login status are kept in memory
+#LOGIN_STATUS_CACHE_SIZE = 10000
 # password encryption key, use
 # > from cryptography.fernet import Fernet
 # > Fernet.generate_key()
 # to generate one, see https://cryptography.io/en/latest/fernet/. If you change
 # or lose it, you cannot decrypt ssh passwords any more.
 DATABASE_PASSWORD_KEY = b'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+# seconds decrypted ssh passwords are kept in memory
+#CREDENTIAL_CACHE_TTL = 10*60
 
 LDAP_SERVER = 'ldap://ldap.example.com'
 LDAP_USER = 'cn=pamtos,ou=system,dc=example,dc=com'
@@ -42,9 +60,51 @@ USERMGR_DELETE_COMMAND = \
     ['usermgr',
     '--server-principal', 'usermgrd/example@example.com',
     'user', 'delete']
+# maximum number of concurrent USERMGR_CREATE_COMMAND processes and their
+# timeout in seconds
+#USERMGR_CONCURRENCY = 4
+#USERMGR_TIMEOUT = 60
 
-# compute node, just one supported right now
+# compute node, or a list of them. Users are distributed across them and
+# moved to another one if a node is unavailable.
 SSH_HOST = 'ssh.example.com'
+# channels per SSH connection, should match sshd’s MaxSessions
+#SSH_MAX_CHANNELS = 10
+# SSH connections per user
+#SSH_MAX_CONNECTIONS = 3
+# seconds between keepalives and number of unanswered ones before a
+# connection is considered dead
+#SSH_KEEPALIVE_INTERVAL = 30
+#SSH_KEEPALIVE_COUNT_MAX = 3
+# reject connection attempts for SSH_BREAKER_TIMEOUT seconds after
+# SSH_BREAKER_THRESHOLD consecutive failures
+#SSH_BREAKER_THRESHOLD = 5
+#SSH_BREAKER_TIMEOUT = 30
+
+# bytes of output per process kept for new browser tabs
+#PROCESS_REPLAY_BYTES = 256*1024
+# bytes queued for a websocket before it is closed as too slow
+#PROCESS_SOCKET_QUEUE_BYTES = 4*1024*1024
+# stop reading process output while all websockets have this many bytes queued
+#PROCESS_SOCKET_HIGH_WATER = 256*1024
+# merge process output for this many seconds or up to this many bytes, 0
+# disables merging
+#PROCESS_OUTPUT_WINDOW = 0.02
+#PROCESS_OUTPUT_BATCH_BYTES = 64*1024
+# running processes per user and in total, others are queued. The per-user
+# limit defaults to, and must not exceed, what the SSH connections can carry:
+# SSH_MAX_CONNECTIONS*SSH_MAX_CHANNELS-1 (one channel is used by SFTP)
+#PROCESS_USER_LIMIT = 29
+#PROCESS_TOTAL_LIMIT = 1024
+# processes started in parallel by /process/batch, and its maximum size
+#PROCESS_BATCH_CONCURRENCY = 4
+#PROCESS_BATCH_MAX_SIZE = 64
+# spool process output to files in this directory, readable through
+# /process/<token>/output. Files are capped at PROCESS_SPOOL_MAX_BYTES and
+# removed PROCESS_SPOOL_KEEP seconds after the process exited.
+#PROCESS_SPOOL_DIR = '/var/lib/bawwab/spool'
+#PROCESS_SPOOL_MAX_BYTES = 64*1024*1024
+#PROCESS_SPOOL_KEEP = 600
 
 EMAIL = dict(
     server="mail.example.com",
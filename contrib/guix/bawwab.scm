@@ -68,6 +68,7 @@
        ("python-websockets" ,python-websockets)
        ("python-aiohttp" ,python-aiohttp)
        ("python-pytz" ,python-pytz)
+       ("python-pyjwt" ,python-pyjwt)
        ("python-tortoise-orm" ,python-tortoise-orm)
        ("python-aiosqlite" ,python-aiosqlite)
        ("python-aiosmtplib" ,python-aiosmtplib)
@@ -20,6 +20,8 @@ setup(
         'tortoise-orm>=0.16.7',
         'aiosqlite',
         'cryptography',
+        # for ID token verification
+        'pyjwt>=2',
 		# for migrations
 		'pypika-tortoise',
 		'pyyaml',
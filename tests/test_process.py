@@ -0,0 +1,112 @@
+import asyncio, json
+
+import pytest
+
+pytest.importorskip ('sanic')
+
+from bawwab.process import ProcessScheduler, ReplayBuffer
+
+async def noNotify (position, queued):
+	pass
+
+def test_scheduler_cancel_while_queued ():
+	""" Cancelled waiters must not leak or take slots """
+	async def run ():
+		s = ProcessScheduler (perUser=1, total=10)
+		await s.acquire ('u', noNotify)
+
+		waiter = asyncio.create_task (s.acquire ('u', noNotify))
+		await asyncio.sleep (0)
+		assert s.waitingTotal == 1
+
+		# release before the waiter handles its cancellation
+		waiter.cancel ()
+		s.release ('u')
+		with pytest.raises (asyncio.CancelledError):
+			await waiter
+
+		assert s.runningTotal == 0
+		assert not s.running
+		assert not s.waiting
+
+		# capacity is available again
+		await asyncio.wait_for (s.acquire ('u', noNotify), 1)
+		assert s.runningTotal == 1
+
+	asyncio.run (run ())
+
+def test_scheduler_fair ():
+	""" Users take turns when slots free up """
+	async def run ():
+		s = ProcessScheduler (perUser=10, total=1)
+		await s.acquire ('a', noNotify)
+		order = []
+		async def job (user):
+			await s.acquire (user, noNotify)
+			order.append (user)
+		tasks = [asyncio.create_task (job (u)) for u in ('a', 'a', 'b')]
+		await asyncio.sleep (0)
+		for i in range (3):
+			s.release (order[-1] if order else 'a')
+			await asyncio.sleep (0)
+		await asyncio.gather (*tasks)
+		assert order == ['a', 'b', 'a']
+
+	asyncio.run (run ())
+
+def replayBuffer (maxBytes, outputs):
+	""" ReplayBuffer with processStart, outputs and processExit """
+	b = ReplayBuffer ('t', maxBytes)
+	seq = 0
+	def add (msg):
+		nonlocal seq
+		msg.update (token='t', seq=seq)
+		seq += 1
+		b.append (msg, json.dumps (msg))
+	add (dict (notify='processStart'))
+	for data in outputs:
+		add (dict (notify='processData', kind='stdout', data=data))
+	add (dict (notify='processExit', status=0))
+	return b
+
+def test_replay_truncate ():
+	""" Oldest output is dropped, start and exit are kept """
+	b = replayBuffer (200, ['x'*100 for i in range (5)])
+	msgs = [json.loads (x) for x in b]
+	assert [m['notify'] for m in msgs] == ['processStart', 'processTruncated',
+			'processData', 'processExit']
+	assert msgs[1]['bytes'] == b.dropped > 0
+	assert msgs[2]['seq'] == 5
+	assert b.size <= 200
+
+def test_replay_keeps_newest ():
+	""" A single message larger than the limit is kept """
+	b = replayBuffer (10, ['x'*100])
+	assert [json.loads (x)['notify'] for x in b] == ['processStart',
+			'processData', 'processExit']
+
+def test_replay_since ():
+	""" Only messages after the cursor are sent """
+	b = replayBuffer (10000, ['a', 'b', 'c'])
+	msgs = [json.loads (x) for x in b.since (2)]
+	assert [m['seq'] for m in msgs] == [3, 4]
+
+	assert list (b.since (4)) == []
+	assert len (list (b.since (-1))) == len (b)
+
+def test_replay_gap ():
+	""" Reconnecting behind dropped output yields a gap notice """
+	b = replayBuffer (200, ['x'*100 for i in range (5)])
+	# only seq 5 (newest output) and 6 (exit) are left
+	msgs = [json.loads (x) for x in b.since (1)]
+	assert [m['notify'] for m in msgs] == ['processGap', 'processData', 'processExit']
+	assert (msgs[0]['start'], msgs[0]['end']) == (2, 5)
+
+	# start is not sent again, gap covers all dropped output
+	msgs = [json.loads (x) for x in b.since (0)]
+	assert msgs[0]['notify'] == 'processGap'
+	assert (msgs[0]['start'], msgs[0]['end']) == (1, 5)
+
+	# right before the retained output, no gap
+	msgs = [json.loads (x) for x in b.since (4)]
+	assert [m['notify'] for m in msgs] == ['processData', 'processExit']
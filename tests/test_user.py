@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip ('sanic')
+pytest.importorskip ('asyncssh')
+
+from bawwab.user import CircuitBreaker, CircuitOpen, HashRing
+
+def test_breaker ():
+	""" closed → open → halfOpen → open again → halfOpen → closed """
+	async def run ():
+		b = CircuitBreaker ('host', threshold=2, timeout=30)
+		assert b.state == 'closed'
+		b.check ()
+		b.failure ()
+		assert b.state == 'closed'
+		b.failure ()
+		assert b.state == 'open'
+		with pytest.raises (CircuitOpen):
+			b.check ()
+
+		# timeout passed
+		b.openedAt -= b.timeout
+		assert b.state == 'halfOpen'
+		# only a single probe
+		b.check ()
+		assert b.state == 'open'
+		with pytest.raises (CircuitOpen):
+			b.check ()
+		# failed probe opens it again, with a new timeout
+		b.failure ()
+		assert b.state == 'open'
+
+		b.openedAt -= b.timeout
+		b.check ()
+		b.success ()
+		assert b.state == 'closed'
+		assert b.failures == 0
+
+	asyncio.run (run ())
+
+def test_breaker_abort ():
+	""" An aborted probe allows another one """
+	async def run ():
+		b = CircuitBreaker ('host', threshold=1, timeout=30)
+		b.failure ()
+		b.openedAt -= b.timeout
+		b.check ()
+		b.abort ()
+		assert b.state == 'halfOpen'
+		b.check ()
+
+	asyncio.run (run ())
+
+def test_breaker_success_resets ():
+	""" Failures must be consecutive """
+	async def run ():
+		b = CircuitBreaker ('host', threshold=2, timeout=30)
+		b.failure ()
+		b.success ()
+		b.failure ()
+		assert b.state == 'closed'
+
+	asyncio.run (run ())
+
+def test_hashring_stable ():
+	""" Placement does not depend on node order and is the same every time """
+	nodes = ['a.example.com', 'b.example.com', 'c.example.com']
+	ring = HashRing (nodes)
+	other = HashRing (reversed (nodes))
+	for i in range (100):
+		key = f'user{i}'
+		order = ring.lookup (key)
+		assert sorted (order) == sorted (nodes)
+		assert order == other.lookup (key)
+		assert order == ring.lookup (key)
+
+def test_hashring_failover ():
+	""" Removing a node only moves its keys, to their next preferred node """
+	nodes = ['a.example.com', 'b.example.com', 'c.example.com']
+	ring = HashRing (nodes)
+	smaller = HashRing (nodes[:-1])
+	for i in range (100):
+		key = f'user{i}'
+		order = ring.lookup (key)
+		assert smaller.lookup (key) == [n for n in order if n != nodes[-1]]
+
+def test_hashring_spread ():
+	""" All nodes get some keys """
+	nodes = ['a.example.com', 'b.example.com', 'c.example.com']
+	ring = HashRing (nodes)
+	first = set (ring.lookup (f'user{i}')[0] for i in range (100))
+	assert first == set (nodes)
+
+def test_hashring_single ():
+	assert HashRing (['a']).lookup ('user') == ['a']